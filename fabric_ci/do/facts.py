@@ -9,6 +9,7 @@ from fabric.api import task, runs_once, hide, settings, run, execute
 import yaml
 import sys
 from pprint import pprint
+from fabric_ci.lib.parallel import iexecute
 
 
 def get_fact_obj(fname):
@@ -44,7 +45,8 @@ def get(fname='', show=True):
     this: "fname|alias fname2|alias2"
 
     It is actually just a wrapper of get_fact_obj to parallelize the fact
-    fetching
+    fetching, when showing them, they are shown as soon as each host returns
+    them
 
     :param fname:
         Facts string, can be in the form "fname|alias1 fname2|alias2", all by
@@ -53,9 +55,9 @@ def get(fname='', show=True):
     with hide('stdout', 'stderr', 'aborts', 'warnings'):
         with settings(hide('running', 'warnings', 'stdout'),
                       warn_only=True):
-            res = execute(get_fact_obj, fname)
-    if show:
-        pprint(res)
-        sys.stdout.flush()
-    else:
-        return res
+            if not show:
+                return execute(get_fact_obj, fname)
+            ## show the facts as soon as each host returns them
+            for host, _, facts in iexecute(get_fact_obj, fname):
+                pprint({host: facts})
+                sys.stdout.flush()
@@ -4,15 +4,11 @@
 This module implements the main tasks used to provision hosts with foreman
 """
 
-COUNTER = True
-try:
-    from collections import Counter
-except ImportError:
-    COUNTER = False
 from fabric.api import (
     task,
     runs_once,
     env,
+    abort,
 )
 from fabric import state
 from fabric_ci.lib.utils import (
@@ -23,8 +19,16 @@ from fabric_ci.lib.utils import (
     puts,
     ifilter_glob,
 )
-from foreman.client import Foreman
-from fabric_ci.lib.foreman import foreman_defaults
+from fabric_ci.lib.foreman import (
+    foreman_defaults,
+    get_client,
+    hostgroup_names,
+    invalidate_hostgroups,
+    iter_hosts,
+)
+from fabric_ci.lib.inventory import Inventory, host_record
+from fabric_ci.lib.snapshot import InventorySnapshot
+from fabric_ci.lib.search import UnsupportedSearch
 
 state.output['running'] = False
 state.output['status'] = False
@@ -41,29 +45,24 @@ def hostgroups_summary(foreman, user, passwd):
     :param user: username to login into Foreman
     :param passwd: Password to use when logging in
     """
-    frm = Foreman(foreman, (user, passwd))
-    hgdict = {}
-    for hg in frm.index_hostgroups(per_page=900):
-        hgdict[hg['hostgroup']['id']] = hg['hostgroup']['name']
+    frm = get_client(foreman, user, passwd)
+    hgdict = hostgroup_names(frm)
     notused = dict(hgdict.iteritems())
-    groups = []
     ## Available
-    hosts = frm.index_hosts(per_page=1000)
-    puts(green("Total Available hosts: ", True) + green(len(hosts)))
+    inventory = Inventory().feed(iter_hosts(frm, fields=('hostgroup_id',)),
+                                 'available')
+    puts(green("Total Available hosts: ", True)
+         + green(inventory.total('available')))
     puts(blue("Available hosts by hostgroup:", True))
-    for next_host in hosts:
-        gid = next_host['host']['hostgroup_id']
+    groups_count = {}
+    for gid, count in inventory.by_group('available').iteritems():
         if gid:
-            groups.append((hgdict[gid], gid))
+            group = (hgdict[gid], gid)
             gid in notused and notused.pop(gid)
         else:
-            groups.append(('No group', 'None'))
-    if COUNTER:
-        groups_count = dict(Counter(groups)).items()
-    else:
-        dict([(item, groups.count(item))
-              for item in sorted(set(groups))]).items()
-    groups_count.sort()
+            group = ('No group', 'None')
+        groups_count[group] = groups_count.get(group, 0) + count
+    groups_count = sorted(groups_count.items())
     for group, count in groups_count:
         gname, gid = group
         if gname != 'No group':
@@ -90,7 +89,7 @@ def _iget_properties(props, foreman, user, passwd):
     :param user: username to login into Foreman
     :param passwd: Password to use when logging in
     """
-    frm = Foreman(foreman, (user, passwd))
+    frm = get_client(foreman, user, passwd)
     props = props.split(':')
     host = frm.show_hosts(env['host'])
     if not host:
@@ -139,7 +138,7 @@ def get_subnet(foreman, user, passwd):
         _iget_properties('subnet_id', foreman=foreman,
                          user=user, passwd=passwd)
     ))
-    frm = Foreman(foreman, (user, passwd))
+    frm = get_client(foreman, user, passwd)
     subnet = frm.show_subnets(subnet_id['subnet_id'])
     if subnet:
         puts(green(env.host + '=')
@@ -147,3 +146,73 @@ def get_subnet(foreman, user, passwd):
              + '|' + blue(subnet['subnet']['network']))
     else:
         puts(red(env.host + ' no subnet found'))
+
+
+@runs_once
+@task
+@foreman_defaults
+def clear_cache(foreman, user, passwd):
+    """
+    Drop the cached hostgroups so the next tasks fetch them again, needed
+    after adding or changing hostgroups if FOREMAN_CACHE_TTL is long
+
+    :param foreman: URL to the foreman server
+    :param user: username to login into Foreman
+    :param passwd: Password to use when logging in
+    """
+    invalidate_hostgroups(get_client(foreman, user, passwd))
+    puts(green("Hostgroups cache cleared"))
+
+
+@runs_once
+@task
+@foreman_defaults
+def refresh_snapshot(full='false', foreman=None, user=None, passwd=None):
+    """
+    Refresh the local inventory snapshot at INVENTORY_SNAPSHOT
+
+    :param full: If true, get all the hosts again instead of only the ones
+        changed since the last refresh
+    :param foreman: URL to the foreman server
+    :param user: username to login into Foreman
+    :param passwd: Password to use when logging in
+    """
+    snapshot = InventorySnapshot.from_env(env)
+    if not snapshot:
+        abort("Please set up INVENTORY_SNAPSHOT in the fabricrc file")
+    snapshot.refresh(get_client(foreman, user, passwd), full=full == 'true')
+    puts(green("Inventory snapshot refreshed"))
+
+
+@runs_once
+@task
+@foreman_defaults
+def check_snapshot(query='', foreman=None, user=None, passwd=None):
+    """
+    Check that searching in the local inventory snapshot gets the same hosts
+    as searching in foreman
+
+    :param query: Foreman search string to check
+    :param foreman: URL to the foreman server
+    :param user: username to login into Foreman
+    :param passwd: Password to use when logging in
+    """
+    snapshot = InventorySnapshot.from_env(env)
+    if not snapshot:
+        abort("Please set up INVENTORY_SNAPSHOT in the fabricrc file")
+    frm = get_client(foreman, user, passwd)
+    snapshot.refresh(frm)
+    try:
+        local = set(host.name for host in snapshot.search(query))
+    except UnsupportedSearch as exc:
+        abort(str(exc))
+    remote = set(host_record(host).name
+                 for host in iter_hosts(frm, search=query, fields=('name',)))
+    for name in sorted(remote - local):
+        puts(red("\tMissing in the snapshot: %s" % name))
+    for name in sorted(local - remote):
+        puts(red("\tNot in foreman: %s" % name))
+    if local == remote:
+        puts(green("Same %d hosts in the snapshot and foreman" % len(local)))
+    else:
+        abort("The snapshot does not match foreman")
@@ -3,29 +3,104 @@
 """
 Manage hosts properties
 """
-
-from foreman import client as cli
-from fabric.api import task
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+from fabric.api import task, env
+from fabric.utils import abort
 from fabric_ci.lib import utils
-from fabric_ci.lib.foreman import foreman_defaults
+from fabric_ci.lib.foreman import foreman_defaults, get_client, iter_hosts
+
+frm_cli = utils.absolute_import('foreman.client', ['ForemanException'])
+MAX_WAIT = 60 * 60 * 24
+
+
+class Checkpoint(object):
+    """
+    File with the ids of the hosts already handled by a set_prop run, so an
+    interrupted run can continue where it stopped. The first line stores the
+    update so it's not resumed with different arguments.
+    """
+    def __init__(self, path, what, m_from, m_to):
+        self.path = path
+        self.header = '# %s: %s -> %s\n' % (what, m_from, m_to)
+        self.done = set()
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as chk_fd:
+                if chk_fd.readline() != self.header:
+                    abort('Checkpoint %s is from another update, remove '
+                          'it or use another one' % path)
+                self.done = set(line.strip() for line in chk_fd)
+        elif path:
+            with open(path, 'w') as chk_fd:
+                chk_fd.write(self.header)
+
+    def __contains__(self, host_id):
+        return str(host_id) in self.done
 
+    def mark(self, host_id):
+        if not self.path:
+            return
+        with self._lock:
+            with open(self.path, 'a') as chk_fd:
+                chk_fd.write('%s\n' % host_id)
+            self.done.add(str(host_id))
+
+    def remove(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _candidates(fcli, what, m_from):
+    """
+    Get the hosts that might have the given value, filtering in the server
+    if the field is searchable
+    """
+    try:
+        return list(iter_hosts(fcli, search='%s = "%s"' % (what, m_from)))
+    except frm_cli.ForemanException:
+        utils.warn('Unable to search by %s, checking all the hosts' % what)
+        return list(iter_hosts(fcli))
 
 
 @task(default=True)
 @foreman_defaults
-def set_prop(what, m_from, m_to, foreman, user, passwd):
+def set_prop(what, m_from, m_to, checkpoint='', workers='', foreman=None,
+             user=None, passwd=None):
     """
     Update the given property if it matches the given value
 
     :param what: Property to update, ex: medium_id.
     :param m_from: Value to match, only update if it matches this value.
     :param m_to: New value to set.
+    :param checkpoint: File to keep track of the updated hosts, if the update
+        gets interrupted, running it again with the same file will skip the
+        hosts already done. Removed when the update finishes.
+    :param workers: Number of hosts to check and update at the same time,
+        SET_PROP_WORKERS from the fabricrc file or 10 by default.
     """
-    fcli = cli.Foreman(foreman, (user, passwd))
-    hosts_index = fcli.index_hosts(per_page='1000')
-    for host in hosts_index:
-        host = fcli.show_hosts(id=host['host']['id'])
+    fcli = get_client(foreman, user, passwd)
+    chk = Checkpoint(checkpoint, what, m_from, m_to)
+    workers = int(workers or env.get('SET_PROP_WORKERS', 10))
+
+    def update(host):
+        ## the index listing might already have the field, skip the request
+        if what not in host['host']:
+            host = fcli.show_hosts(id=host['host']['id'])
         if what in host['host'] and str(host['host'][what]) == m_from:
             utils.info('Updating host %s, [ %s: from %s to %s ]'
-                    % (host['host']['name'], what, m_from, m_to))
+                       % (host['host']['name'], what, m_from, m_to))
             fcli.update_hosts(id=host['host']['id'], host={what: m_to})
+        chk.mark(host['host']['id'])
+
+    hosts_index = [host for host in _candidates(fcli, what, m_from)
+                   if host['host']['id'] not in chk]
+    if hosts_index:
+        pool = ThreadPool(min(workers, len(hosts_index)))
+        try:
+            ## with a timeout so it can be interrupted with ctrl+c
+            pool.map_async(update, hosts_index).get(timeout=MAX_WAIT)
+        finally:
+            pool.close()
+    chk.remove()
@@ -4,12 +4,11 @@
 This module implements the main tasks used to provision hosts with foreman
 """
 import time
-import datetime
-try:
-    from collections import Counter
-    COUNTER = True
-except ImportError:
-    COUNTER = False
+import Queue
+import signal
+import cPickle
+import threading
+import multiprocessing
 import traceback
 from requests.exceptions import (
     ConnectionError,
@@ -18,6 +17,7 @@ from requests.exceptions import (
 from fabric.api import (
     task,
     serial,
+    parallel,
     runs_once,
     run,
     execute,
@@ -48,9 +48,36 @@ from fabric_ci.lib.utils import (
     puts,
     ts,
     fancy,
+    Backoff,
 )
-from fabric_ci.lib.foreman import foreman_defaults
-frm_cli = absolute_import('foreman.client', ['Foreman', 'Unacceptable'])
+from fabric_ci.lib.foreman import (
+    foreman_defaults,
+    get_client,
+    prewarm,
+    client_stats,
+    get_hostgroups,
+    get_hostgroup,
+    hostgroup_names,
+    show_hosts_details,
+    iter_hosts,
+    iter_hostgroups,
+    hosts_query,
+    bulk_call,
+)
+from fabric_ci.lib.parallel import iexecute
+from fabric_ci.lib.liveness import check_hosts, is_alive
+from fabric_ci.lib.history import BuildHistory, DemandHistory
+from fabric_ci.lib.inventory import (
+    provision_inventory,
+    host_record,
+    reservation,
+    USER_RESERVED,
+    UNAVAILABLE,
+)
+from fabric_ci.lib.nagios import NagiosPlugin, Limit
+from fabric_ci.lib.snapshot import search_snapshot
+frm_cli = absolute_import('foreman.client',
+                          ['Foreman', 'Unacceptable', 'ForemanException'])
 
 state.output['running'] = False
 state.output['status'] = False
@@ -63,26 +90,6 @@ class BuildTimeout(Exception):
     pass
 
 
-def get_prop_dict(host):
-    """
-    Helper to get a dictionary with the properties of a host
-
-    :param host: Host to get the properties from as returned from foreman api
-    """
-    prop_dict = {}
-    host = host['host']
-    if 'host_parameters' in host:
-        params = host['host_parameters']
-        par_key = 'host_parameter'
-    else:
-        params = host['parameters']
-        par_key = 'parameter'
-    for prop in params:
-        prop_dict[prop[par_key]['name']] \
-            = prop[par_key]['value']
-    return prop_dict
-
-
 def add_hosts_to_query(query='', hosts=None):
     """
     Add the env.hosts or the given hosts to the given foreman query.
@@ -92,49 +99,52 @@ def add_hosts_to_query(query='', hosts=None):
     """
     hosts = hosts or env.hosts
     if hosts:
-        query += (query and ' AND' or '') \
-            + ' ( name=%s )' % ' OR name='.join(hosts)
+        query = hosts_query(hosts, query)
     return query
 
 
+def set_state(method, hosts, label, **kwargs):
+    """
+    Change the reservation state of the given hosts in bulk, and show how
+    many of them were affected
+
+    :param method: Reserve plugin method, like frm.update_reserved_reason
+    :param hosts: list of host names or host records
+    :param label: Name of the state change to show
+    :param kwargs: Any other parameters for the method
+    :returns: All the elements returned by the method
+    """
+    names = [isinstance(host, basestring) and host or host_record(host).name
+             for host in hosts]
+    if not names:
+        return []
+    res = bulk_call(method, names, **kwargs)
+    info("%s: %d of %d hosts" % (label, len(res), len(names)))
+    return res
+
+
 def is_user_reserved(host):
-    props = get_prop_dict(host)
-    if 'RESERVED' in props and 'RESERVED' in props['RESERVED']:
-        return props['RESERVED']
+    record = reservation(host)
+    if record and record.tags & USER_RESERVED:
+        return record.reason
     return False
 
 
 def is_unavailable(host):
-    props = get_prop_dict(host)
-    if 'RESERVED' in props and 'UNAVAILABLE' in props['RESERVED'].upper():
-        return props['RESERVED']
+    record = reservation(host)
+    if record and record.tags & UNAVAILABLE:
+        return record.reason
     return False
 
 
-def is_stuck(host, timeout=60*60*23):
-    reason = ''
-    host = host['host']
-    if 'host_parameters' in host:
-        params = host['host_parameters']
-        par_key = 'host_parameter'
-    else:
-        params = host['parameters']
-        par_key = 'parameter'
-    for param in params:
-        if param[par_key]['name'].lower() == 'RESERVED'.lower():
-            reason = param[par_key]['value']
-            updated = param[par_key]['updated_at']
-            break
-    if reason:
-        updated = int(
-            datetime.datetime.strptime(
-                updated,
-                '%Y-%m-%dT%H:%M:%SZ'
-            ).strftime('%s')
-        )
-        now = int(datetime.datetime.now().strftime('%s'))
-        if timeout < (now - updated):
-            return reason
+def is_stuck(host, timeout=60*60*23, now=None):
+    """
+    :param now: Timestamp to compare to, now by default, pass it when
+        checking many hosts so all of them are compared to the same moment
+    """
+    record = reservation(host)
+    if record and record.is_stuck(now or time.time(), timeout):
+        return record.reason
     return False
 
 
@@ -147,48 +157,81 @@ def show(foreman=None, user=None, passwd=None):
 
     """
     query = add_hosts_to_query()
-    frm = frm_cli.Foreman(foreman, (user, passwd))
-    hgdict = {}
+    frm = get_client(foreman, user, passwd)
+    hgdict = hostgroup_names(frm)
     hgdict[None] = "No group"
-    for hg in frm.index_hostgroups(per_page=999):
-        hgdict[hg['hostgroup']['id']] = hg['hostgroup']['name']
     if TTY:
         puts("{0:<38}\t{1:<35}\t{2:<28}".format(blue("Host", True),
                                                 cyan("Profile", True),
                                                 green("Reason", True)))
-    hosts_info = frm.index_hosts(search=query, per_page=999)
+    hosts_info = search_snapshot(frm, query)
+    if hosts_info is None:
+        hosts_info = show_hosts_details(
+            frm, list(iter_hosts(frm, search=query)))
     for next_host in hosts_info:
-        next_host = frm.show_hosts(next_host['host']['id'])
-        props = get_prop_dict(next_host)
+        next_host = host_record(next_host)
         puts("{0:<38}\t{1:<35}\t{2:<28}".format(
-            blue(next_host['host']['name']),
-            cyan(hgdict[next_host['host']['hostgroup_id']]),
-            'RESERVED' in props
-            and green(props['RESERVED']) or ''))
+            blue(next_host.name),
+            cyan(hgdict[next_host.hostgroup_id]),
+            'RESERVED' in next_host.params
+            and green(next_host.params['RESERVED']) or ''))
 
 
-@runs_once
-@task
-@foreman_defaults
-def show_stuck(query='', foreman=None, user=None, passwd=None):
+def _reserved_hosts(frm, query, narrow=''):
     """
-    Show all the hosts that are stuck
+    Get the reserved hosts that match the query, and the narrowing search if
+    the server supports searching by it
+
+    :param query: Foreman search string
+    :param narrow: Extra search to only get the hosts that might be
+        interesting, as the server can't match exactly what we need
     """
-    frm = frm_cli.Foreman(foreman, (user, passwd))
-    hgdict = {}
-    for hg in frm.index_hostgroups(per_page=999):
-        hgdict[hg['hostgroup']['id']] = hg['hostgroup']['name']
+    hosts = search_snapshot(frm, query, reserved=True)
+    if hosts is not None:
+        return hosts
+    if narrow:
+        try:
+            return frm.show_reserved(
+                query=query and '( %s ) AND %s' % (query, narrow) or narrow)
+        except frm_cli.ForemanException:
+            warn('Unable to search by %s, checking all the hosts' % narrow)
+    return frm.show_reserved(query=query)
+
+
+def _show_reservations(frm, query, match, narrow=''):
+    """
+    Show the reserved hosts whose reservation matches
+
+    :param match: Function that gets a :class:`Reservation` and returns True
+        if the host has to be shown
+    :param narrow: See :func:`_reserved_hosts`
+    """
+    hgdict = hostgroup_names(frm)
     if TTY:
         puts("{0:<38}\t{1:<35}\t{2:<28}".format(blue("Host", True),
                                                 cyan("Profile", True),
                                                 green("Reason", True)))
-    for host, reason in ((host, is_stuck(host))
-                         for host in frm.show_reserved(query=query)
-                         if is_stuck(host)):
+    for host in _reserved_hosts(frm, query, narrow):
+        host = host_record(host)
+        record = reservation(host)
+        if record is None or not match(record):
+            continue
         puts("{0:<38}\t{1:<35}\t{2:<28}".format(
-            blue(host['host']['name']),
-            cyan(hgdict[host['host']['hostgroup_id']]),
-            green(reason)))
+            blue(host.name),
+            cyan(hgdict[host.hostgroup_id]),
+            green(record.reason)))
+
+
+@runs_once
+@task
+@foreman_defaults
+def show_stuck(query='', foreman=None, user=None, passwd=None):
+    """
+    Show all the hosts that are stuck
+    """
+    frm = get_client(foreman, user, passwd)
+    now = time.time()
+    _show_reservations(frm, query, lambda record: record.is_stuck(now))
 
 
 @runs_once
@@ -198,21 +241,10 @@ def show_user_reserved(query='', foreman=None, user=None, passwd=None):
     """
     Show all the hosts that are reserved by users (not automatically reserved)
     """
-    frm = frm_cli.Foreman(foreman, (user, passwd))
-    hgdict = {}
-    for hg in frm.index_hostgroups(per_page=999):
-        hgdict[hg['hostgroup']['id']] = hg['hostgroup']['name']
-    if TTY:
-        puts("{0:<38}\t{1:<35}\t{2:<28}".format(blue("Host", True),
-                                                cyan("Profile", True),
-                                                green("Reason", True)))
-    for host, reason in ((host, is_user_reserved(host))
-                         for host in frm.show_reserved(query=query)
-                         if is_user_reserved(host)):
-        puts("{0:<38}\t{1:<35}\t{2:<28}".format(
-            blue(host['host']['name']),
-            cyan(hgdict[host['host']['hostgroup_id']]),
-            green(reason)))
+    frm = get_client(foreman, user, passwd)
+    _show_reservations(frm, query,
+                       lambda record: record.tags & USER_RESERVED,
+                       narrow='params.RESERVED ~ RESERVED')
 
 
 @runs_once
@@ -222,21 +254,10 @@ def show_unavailable(query='', foreman=None, user=None, passwd=None):
     """
     Show all the hsots that are set as unavailable (not reachable through ssh)
     """
-    frm = frm_cli.Foreman(foreman, (user, passwd))
-    hgdict = {}
-    for hg in frm.index_hostgroups(per_page=999):
-        hgdict[hg['hostgroup']['id']] = hg['hostgroup']['name']
-    if TTY:
-        puts("{0:<38}\t{1:<35}\t{2:<28}".format(blue("Host", True),
-                                                cyan("Profile", True),
-                                                green("Reason", True)))
-    for host, reason in ((host, is_unavailable(host))
-                         for host in frm.show_reserved(query=query)
-                         if is_unavailable(host)):
-        puts("{0:<38}\t{1:<35}\t{2:<28}".format(
-            blue(host['host']['name']),
-            cyan(hgdict[host['host']['hostgroup_id']]),
-            green(reason)))
+    frm = get_client(foreman, user, passwd)
+    _show_reservations(frm, query,
+                       lambda record: record.tags & UNAVAILABLE,
+                       narrow='params.RESERVED ~ UNAVAILABLE')
 
 
 @runs_once
@@ -248,10 +269,9 @@ def show_profiles(foreman, user, passwd):
     """
     if 'PROVISION_GROUP_PREFIX' not in env:
         fail("Please set up PROVISION_GROUP_PREFIX in the fabricrc file")
-    frm = frm_cli.Foreman(foreman, (user, passwd))
-    for group in frm.index_hostgroups(
-            per_page=999,
-            search='name~%s' % env.PROVISION_GROUP_PREFIX):
+    frm = get_client(foreman, user, passwd)
+    for group in iter_hostgroups(
+            frm, search='name~%s' % env.PROVISION_GROUP_PREFIX):
         puts(group['hostgroup']['name'])
 
 
@@ -268,52 +288,77 @@ def show_summary(foreman, user, passwd):
     """
     if 'PROVISION_GROUP_PREFIX' not in env:
         fail("Please set up PROVISION_GROUP_PREFIX in the fabricrc file")
-    frm = frm_cli.Foreman(foreman, (user, passwd))
-    hgdict = {}
-    for hg in frm.index_hostgroups(per_page=999):
-        if hg['hostgroup']['name'].startswith(env.PROVISION_GROUP_PREFIX):
-            hgdict[hg['hostgroup']['id']] = hg['hostgroup']['name']
-    a_groups, r_groups = [], []
+    frm = get_client(foreman, user, passwd)
+    names = hostgroup_names(frm)
+    inventory = provision_inventory(frm, env.PROVISION_GROUP_PREFIX)
     ## Available
-    available_hosts = frm.show_available(query="hostgroup ~ %s%%"
-                                         % env.PROVISION_GROUP_PREFIX)
-    puts(green("Total Available hosts: ", True) + green(len(available_hosts)))
+    puts(green("Total Available hosts: ", True)
+         + green(inventory.total('available')))
     puts(blue("Available hosts by profile:", True))
-    for next_host in available_hosts:
-        a_groups.append(next_host['host']['hostgroup_id'])
-    ## For python 2.6 compatibility
-    if COUNTER:
-        a_groups_count = dict(Counter(a_groups))
-    else:
-        a_groups_count = dict([(item, a_groups.count(item))
-                               for item in sorted(set(a_groups))])
-    for gid, count in a_groups_count.iteritems():
-        puts(blue("\t%s (id=%d) = %s" % (hgdict[gid], gid, white(count))))
+    for gid, count in inventory.by_group('available').iteritems():
+        puts(blue("\t%s (id=%d) = %s" % (names[gid], gid, white(count))))
     ## Reserved
-    reserved_hosts = frm.show_reserved()
-    puts(green("Total Reserved hosts: ", True) + green(len(reserved_hosts)))
+    puts(green("Total Reserved hosts: ", True)
+         + green(inventory.total('reserved')))
     puts(blue("Resrved hosts by profile:", True))
-    for next_host in reserved_hosts:
-        r_groups.append(next_host['host']['hostgroup_id'])
-    if COUNTER:
-        r_groups_count = dict(Counter(r_groups))
-    else:
-        r_groups_count = dict([(item, r_groups.count(item))
-                               for item in sorted(set(r_groups))])
-    for gid, count in r_groups_count.iteritems():
-        puts(blue("\t%s (id=%d) = %s" % (hgdict[gid], gid, white(count))))
-    ## Unused
+    for gid, count in inventory.by_group('reserved').iteritems():
+        puts(blue("\t%s (id=%d) = %s" % (names[gid], gid, white(count))))
+    ## Unused, the lookups above might have refreshed the hostgroups
     puts(blue("Unused profiles:", True))
-    for gid in a_groups_count.iterkeys():
-        if gid in hgdict:
-            hgdict.pop(gid)
-    for gid in r_groups_count.iterkeys():
+    hgdict = {}
+    for hg in get_hostgroups(frm):
+        if hg['hostgroup']['name'].startswith(env.PROVISION_GROUP_PREFIX):
+            hgdict[hg['hostgroup']['id']] = hg['hostgroup']['name']
+    for gid in inventory.groups():
         if gid in hgdict:
             hgdict.pop(gid)
     for gid, name in hgdict.iteritems():
         puts(blue("\t%s (id=%s)" % (name, gid)))
 
 
+def _limit(levels, cmp_func=None):
+    warn_lvl, crit_lvl = (int(level) for level in levels.split(','))
+    return Limit(warn_lvl, crit_lvl, cmp_func)
+
+
+@runs_once
+@task
+@foreman_defaults
+def check_summary(available='2,1', stuck='0,5', unavailable='0,5',
+                  foreman=None, user=None, passwd=None):
+    """
+    Nagios check of the hosts of each profile, with the same numbers as
+    show_summary
+
+    :param available: Warning and critical levels (comma separated) for the
+        min number of available hosts
+    :param stuck: Warning and critical levels for the max number of stuck
+        hosts
+    :param unavailable: Warning and critical levels for the max number of
+        unavailable hosts
+    :param foreman: URL to the foreman server
+    :param user: username to login into Foreman
+    :param passwd: Password to use when logging in
+    """
+    if 'PROVISION_GROUP_PREFIX' not in env:
+        fail("Please set up PROVISION_GROUP_PREFIX in the fabricrc file")
+    frm = get_client(foreman, user, passwd)
+    inventory = provision_inventory(frm, env.PROVISION_GROUP_PREFIX)
+    states = ('available', 'reserved', 'stuck', 'unavailable')
+    check = NagiosPlugin('Provision',
+                         _limit(available, lambda x, y: x < y),
+                         Limit(0, 0, lambda *x: False),
+                         _limit(stuck),
+                         _limit(unavailable))
+    names = hostgroup_names(frm)
+    ## only the provision profiles have their available hosts counted
+    profiles = [gid for gid, name in names.iteritems()
+                if name.startswith(env.PROVISION_GROUP_PREFIX)]
+    for tag, values in inventory.nagios_data(states, names, gids=profiles):
+        check.add_data(tag, *values)
+    check.do_check()
+
+
 @runs_once
 @task
 @foreman_defaults
@@ -329,22 +374,21 @@ def show_available(query='', amount=0, foreman=None, user=None, passwd=None):
     """
     if 'PROVISION_GROUP_PREFIX' not in env:
         fail("Please set up PROVISION_GROUP_PREFIX in the fabricrc file")
-    frm = frm_cli.Foreman(foreman, (user, passwd))
+    frm = get_client(foreman, user, passwd)
     if query:
         query = "( %s ) AND hostgroup ~ %s%%" \
                 % (query, env.PROVISION_GROUP_PREFIX)
     else:
         query = "hostgroup ~ %s%%" % env.PROVISION_GROUP_PREFIX
-    hgdict = {}
-    for hg in frm.index_hostgroups(per_page=999):
-        hgdict[hg['hostgroup']['id']] = hg['hostgroup']['name']
+    hgdict = hostgroup_names(frm)
     if TTY:
         puts("{0:<40}\t{1:<38}".format(blue("Host", True),
                                        cyan("Profile", True)))
     for next_host in frm.show_available(query=query, amount=amount):
+        next_host = host_record(next_host)
         puts("{0:<40}\t{1:<38}".format(
-            blue(next_host['host']['name']),
-            cyan(hgdict[next_host['host']['hostgroup_id']])))
+            blue(next_host.name),
+            cyan(hgdict[next_host.hostgroup_id])))
 
 
 @runs_once
@@ -359,21 +403,19 @@ def show_reserved(query='', foreman=None, user=None, passwd=None):
     :param user: username to login into Foreman
     :param passwd: Password to use when logging in
     """
-    frm = frm_cli.Foreman(foreman, (user, passwd))
-    hgdict = {}
-    for hg in frm.index_hostgroups(per_page=999):
-        hgdict[hg['hostgroup']['id']] = hg['hostgroup']['name']
+    frm = get_client(foreman, user, passwd)
+    hgdict = hostgroup_names(frm)
     if TTY:
         puts("{0:<38}\t{1:<35}\t{2:<28}".format(blue("Host", True),
                                                 cyan("Profile", True),
                                                 green("Reason", True)))
-    for next_host in frm.show_reserved(query=query):
-        props = get_prop_dict(next_host)
+    for next_host in _reserved_hosts(frm, query):
+        next_host = host_record(next_host)
         puts("{0:<38}\t{1:<35}\t{2:<28}".format(
-            blue(next_host['host']['name']),
-            cyan(hgdict[next_host['host']['hostgroup_id']]),
-            'RESERVED' in props
-            and green(props['RESERVED']) or ''))
+            blue(next_host.name),
+            cyan(hgdict[next_host.hostgroup_id]),
+            'RESERVED' in next_host.params
+            and green(next_host.params['RESERVED']) or ''))
 
 
 @runs_once
@@ -396,10 +438,8 @@ def update_reason(reason, query='', add_ts='true', add_tag='true', foreman=None,
         reason = '[USER_RESERVED] ' + reason
     if add_ts == 'true':
         reason = ts(reason)
-    frm = frm_cli.Foreman(foreman, (user, passwd))
-    hgdict = {}
-    for hg in frm.index_hostgroups(per_page=999):
-        hgdict[hg['hostgroup']['id']] = hg['hostgroup']['name']
+    frm = get_client(foreman, user, passwd)
+    hgdict = hostgroup_names(frm)
     if TTY:
         info("Updating all the hosts matching this query:")
         info("\t%s" % query)
@@ -409,12 +449,12 @@ def update_reason(reason, query='', add_ts='true', add_tag='true', foreman=None,
                                                 cyan("Profile", True),
                                                 green("Reason", True)))
     for next_host in frm.update_reserved_reason(reason=reason, query=query):
-        props = get_prop_dict(next_host)
+        next_host = host_record(next_host)
         puts("{0:<38}\t{1:<35}\t{2:<28}".format(
-            blue(next_host['host']['name']),
-            cyan(hgdict[next_host['host']['hostgroup_id']]),
-            'RESERVED' in props
-            and green(props['RESERVED']) or ''))
+            blue(next_host.name),
+            cyan(hgdict[next_host.hostgroup_id]),
+            'RESERVED' in next_host.params
+            and green(next_host.params['RESERVED']) or ''))
 
 
 @runs_once
@@ -436,7 +476,7 @@ def release(query='', foreman=None, user=None, passwd=None):
         if res.lower() == 'n':
             info("Quitting")
             return
-    frm = frm_cli.Foreman(foreman, (user, passwd))
+    frm = get_client(foreman, user, passwd)
     if TTY:
         info("Releasing all the hosts matching this query:")
         info("\t%s" % query)
@@ -445,13 +485,19 @@ def release(query='', foreman=None, user=None, passwd=None):
         puts("{0:<80}".format(green(hostname)))
 
 
-def test_ssh(host, command='uptime'):
+def test_ssh(host, command='uptime', precheck=True):
     """
     Test if a host is reachable through ssh
 
     :param host: Host to test
     :param command: Command to run when connecting
+    :param precheck: Check first that the host sends the ssh banner, that's
+        way cheaper than opening the ssh session if it's down. Skipped for
+        the hosts behind a gateway or proxy, see
+        :func:`fabric_ci.lib.liveness.is_direct`
     """
+    if precheck and not is_alive(host):
+        return False
     try:
         with settings(
                 hide('running', 'stdout', 'stderr'),
@@ -469,6 +515,99 @@ def test_ssh(host, command='uptime'):
     return False
 
 
+class ProbeTimeout(Exception):
+    """
+    Helper exception when a host takes too long to answer the ssh probe
+    """
+    pass
+
+
+def _probe_timeout(signum, frame):
+    raise ProbeTimeout()
+
+
+def _probe_ssh(command='uptime', deadline=30):
+    """
+    Parallel task wrapper around :func:`test_ssh` that gives up on the host
+    after deadline seconds. The deadline is only enforced when running in
+    the main thread of the job (the default process backend).
+    """
+    use_alarm = threading.current_thread().name == 'MainThread'
+    if use_alarm:
+        old_handler = signal.signal(signal.SIGALRM, _probe_timeout)
+        signal.alarm(int(deadline))
+    try:
+        return test_ssh(env.host_string, command=command, precheck=False)
+    except ProbeTimeout:
+        return False
+    finally:
+        if use_alarm:
+            signal.alarm(0)
+            signal.signal(signal.SIGALRM, old_handler)
+
+
+def iprobe_ssh(hosts, command='uptime'):
+    """
+    Probe the given hosts through ssh concurrently, yielding (host, is_up)
+    as soon as each one is checked
+
+    The hosts that do not send the ssh banner are down right away, only the
+    rest (and the ones behind a gateway or proxy, that can't be checked that
+    way) are checked running the command. The max number of concurrent
+    probes is SSH_PROBE_POOL from the fabricrc file (20 by default) and each
+    probe can take at most SSH_PROBE_DEADLINE seconds (30 by default), after
+    that the host is considered down.
+
+    :param hosts: list of host names to probe
+    :param command: Command to run when connecting
+    """
+    alive = check_hosts(hosts)
+    for host in hosts:
+        if not alive[host]:
+            yield host, False
+    hosts = [host for host in hosts if alive[host]]
+    if not hosts:
+        return
+    pool_size = int(env.get('SSH_PROBE_POOL', 20))
+    deadline = int(env.get('SSH_PROBE_DEADLINE', 30))
+    probe = parallel(pool_size=pool_size)(_probe_ssh)
+    with settings(warn_only=True):
+        for host, exit_code, is_up in iexecute(probe, command=command,
+                                               deadline=deadline,
+                                               hosts=hosts):
+            yield host, exit_code == 0 and is_up is True
+
+
+def wait_for_available(frm, query, delay):
+    """
+    Wait up to delay seconds for a host matching the query to become
+    available, so a release is noticed without waiting the whole delay.
+
+    Foreman is checked every half of the delay, but never more often than
+    each RESERVE_POLL_INTERVAL seconds (30 by default), and not at the end
+    of the delay, as the caller tries to reserve right after. So there's at
+    most one check per wait with the default values.
+
+    :param frm: Foreman client
+    :param query: Query the hosts must match
+    :param delay: Max number of seconds to wait
+    :returns: True if some host was seen available before the delay
+    """
+    poll = max(float(env.get('RESERVE_POLL_INTERVAL', 30)), delay / 2.0)
+    deadline = time.time() + delay
+    while True:
+        left = deadline - time.time()
+        if left <= poll:
+            time.sleep(max(left, 0))
+            return False
+        time.sleep(poll)
+        try:
+            if frm.show_available(query=query, amount=1):
+                return True
+        except (frm_cli.ForemanException, ConnectionError, Timeout):
+            pass
+
+
 @runs_once
 @serial
 @task
@@ -483,7 +622,9 @@ def reserve(query='', reason='', amount=0, tries=120, timeout=60, ensure_ssh='tr
     :param query: Use this query for selecting the hosts
     :param reason: New reason to put into
     :param amount: Reserve only this amount of hosts
-    :param tries: Number of attempts to reserve
+    :param tries: Number of attempts to reserve, see :func:`_reserve`
+    :param timeout: Max seconds to wait between attempts, see
+        :func:`_reserve`
     :param ensure_ssh: Try to connect using ssh before reservingf the host
     :param add_tag: Add the 'RESERVED' tg to the reason, for nagios to ignore
     :param add_ts: Add the timestamp to the reasom message
@@ -496,7 +637,7 @@ def reserve(query='', reason='', amount=0, tries=120, timeout=60, ensure_ssh='tr
              add_tag=add_tag, show=show)
 
 
-def _reserve(query='', reason='', amount=0, tries=120, timeout=60, ensure_ssh='true', add_tag='true', show=True, foreman=None, user=None, passwd=None):
+def _reserve(query='', reason='', amount=0, tries=120, timeout=60, ensure_ssh='true', add_tag='true', show=True, foreman=None, user=None, passwd=None, pipeline=None):
     """
     Reserve the given host or hosts (real function)
 
@@ -506,12 +647,21 @@ def _reserve(query='', reason='', amount=0, tries=120, timeout=60, ensure_ssh='t
     :param query: Use this query for selecting the hosts
     :param reason: New reason to put into
     :param amount: Reserve only this amount of hosts
-    :param tries: Number of attempts to reserve
+    :param tries: Number of attempts to reserve, it keeps trying for at
+        least tries * timeout seconds, as it did when it always waited
+        timeout seconds between attempts
+    :param timeout: Max seconds to wait between attempts, the wait starts at
+        RESERVE_BACKOFF_MIN seconds (5 by default) and doubles after each
+        failed attempt, but it ends as soon as there are available hosts
     :param ensure_ssh: Try to connect using ssh before reservingf the host
     :param add_tag: Add the 'RESERVED' tg to the reason, for nagios to ignore
     :param add_ts: Add the timestamp to the reasom message
     :param show: Show the results, used when not called from fab client
                  directly
+    :param pipeline: :class:`RebuildPipeline` to pass each host to as soon
+        as it's reserved and reachable, if not enough hosts are reserved in
+        the end it's aborted, the hosts that are still building are marked
+        as unavailable and the rest released
     """
     tries = int(tries)
     timeout = int(timeout)
@@ -531,52 +681,64 @@ def _reserve(query='', reason='', amount=0, tries=120, timeout=60, ensure_ssh='t
     frm = None
     while not frm and tries:
         try:
-            frm = frm_cli.Foreman(foreman, (user, passwd))
+            frm = get_client(foreman, user, passwd)
         except (ConnectionError, Timeout):
             error("Got an exception while trying to connect to foreman.")
             traceback.print_exc()
             info("Waiting %ds before retrying..." % timeout)
             time.sleep(timeout)
             tries -= 1
-    hgdict = {}
-    for hg in frm.index_hostgroups(per_page=999):
-        hgdict[hg['hostgroup']['id']] = hg['hostgroup']['name']
+    hgdict = hostgroup_names(frm)
+    backoff = Backoff(min(float(env.get('RESERVE_BACKOFF_MIN', 5)), timeout),
+                      timeout)
+    ## the back-off retries sooner, so it would give up way earlier if only
+    ## the attempts were counted, keep trying for the whole tries * timeout
+    deadline = time.time() + tries * timeout
     ############################
     ## Reserve
     ############################
     try:
-        while len(up_hosts) < amount and tries:
-            info(("Trying to get enough hosts each %ds, have %d of %d, %d "
-                 "tries left") % (timeout, len(up_hosts), amount, tries))
-            tries -= 1
+        while len(up_hosts) < amount and (tries or time.time() < deadline):
+            info(("Trying to get enough hosts, have %d of %d, %ds left")
+                 % (len(up_hosts), amount, max(deadline - time.time(), 0)))
+            tries = max(tries - 1, 0)
             try:
-                hosts_list = frm.hosts_reserve(query=query,
-                                               amount=(amount - len(up_hosts)),
-                                               reason=ts('[QUEUED] %s'
-                                                         % reason))
+                hosts_list = [host_record(host) for host in frm.hosts_reserve(
+                    query=query,
+                    amount=(amount - len(up_hosts)),
+                    reason=ts('[QUEUED] %s' % reason)) or []]
                 if not hosts_list:
                     raise frm_cli.Unacceptable(None, None)
             except frm_cli.Unacceptable:
                 hosts_list = []
             if ensure_ssh == 'true':
                 to_explore_hosts = [h for h in hosts_list]
-                for index, next_host in enumerate(hosts_list):
-                    puts("Connecting to %s: " % next_host['host']['name'],
-                         end='')
-                    if test_ssh(next_host['host']['name']):
+                by_name = dict((h.name, h) for h in hosts_list)
+                for name, is_up in iprobe_ssh(by_name.keys()):
+                    next_host = by_name[name]
+                    to_explore_hosts.remove(next_host)
+                    if is_up:
                         up_hosts.append(next_host)
-                        puts(green("up and running."))
-                        to_explore_hosts.pop(0)
+                        puts("Connecting to %s: %s"
+                             % (name, green("up and running.")))
+                        pipeline and pipeline.add(name)
                     else:
                         down_hosts.append(next_host)
-                        puts(red("UNAVAILABLE."))
-                        to_explore_hosts.pop(0)
-                        hosts_list.pop(index)
+                        puts("Connecting to %s: %s"
+                             % (name, red("UNAVAILABLE.")))
             else:
+                up_hosts.extend(hosts_list)
                 for host in hosts_list:
-                    up_hosts.append(host['host']['name'])
-            if len(up_hosts) < amount and tries:
-                time.sleep(timeout)
+                    pipeline and pipeline.add(host.name)
+            left = deadline - time.time()
+            if len(up_hosts) < amount and (tries or left > 0):
+                if hosts_list:
+                    backoff.reset()
+                delay = backoff.next()
+                if left > 0:
+                    delay = min(delay, left)
+                info("Waiting up to %.1fs for available hosts" % delay)
+                wait_for_available(frm, query, delay)
     except Exception:
         traceback.print_exc()
         raise
@@ -584,43 +746,52 @@ def _reserve(query='', reason='', amount=0, tries=120, timeout=60, ensure_ssh='t
         ## Cleanup if needed
         ## Mark the hosts that failed to connect
         if down_hosts:
-            down_names = [h['host']['name'] for h in down_hosts]
+            down_names = [h.name for h in down_hosts]
             warn("Removing unavailable hosts from the pool.\n%s"
                  % down_names)
-            down_query = add_hosts_to_query(hosts=down_names)
-            frm.update_reserved_reason(reason=ts("[UNAVAILABLE] %s"
-                                                 % reason),
-                                       query=down_query)
+            set_state(frm.update_reserved_reason, down_names, 'UNAVAILABLE',
+                      reason=ts("[UNAVAILABLE] %s" % reason))
             down_hosts = []
         ## If not able to get enough, free all the reserved ones
         if len(up_hosts) < amount:
             warn("Not enough hosts available for query %s." % query)
+            if pipeline:
+                ## never release a host in the middle of its install, mark
+                ## it so it's checked before going back to the pool
+                building = sorted(pipeline.abort())
+                if building:
+                    warn("Marking the hosts still building as unavailable:"
+                         "\n\t%s" % building)
+                    set_state(frm.update_reserved_reason, building,
+                              'UNAVAILABLE',
+                              reason=ts("[UNAVAILABLE] Build interrupted %s"
+                                        % reason))
+                up_hosts = [h for h in up_hosts if h.name not in building]
             if to_explore_hosts:
-                to_explore_hosts = [h['host']['name']
-                                    for h in to_explore_hosts]
+                to_explore_hosts = [h.name for h in to_explore_hosts]
                 puts("Releasing untested hosts:\n\t%s" % to_explore_hosts)
-                query = add_hosts_to_query(hosts=to_explore_hosts)
-                hosts_list = frm.hosts_release(query=query)
+                set_state(frm.hosts_release, to_explore_hosts, 'RELEASED')
             if up_hosts:
-                up_hosts = [h['host']['name'] for h in up_hosts]
+                up_hosts = [h.name for h in up_hosts]
                 info("Releasing healthy hosts:\n\t%s" % up_hosts)
-                query = add_hosts_to_query(hosts=up_hosts)
-                hosts_list = frm.hosts_release(query=query)
+                set_state(frm.hosts_release, up_hosts, 'RELEASED')
             return []
+        elif pipeline:
+            ## the hosts are already being rebuilt, don't touch their reason
+            return up_hosts
         else:
             ## Update the reason to the original one, we finished
-            query = add_hosts_to_query(hosts=[h['host']['name']
-                                              for h in up_hosts])
-            hosts_list = frm.update_reserved_reason(query=query,
-                                                    reason=ts(reason))
+            hosts_list = [host_record(host) for host in set_state(
+                frm.update_reserved_reason, up_hosts, 'RESERVED',
+                reason=ts(reason))]
             if TTY and show and up_hosts:
                 puts("{0:<38}\t{1:<35}\t{2:<28}".format(blue("Host", True),
                                                         cyan("Profile", True),
                                                         green("Reason", True)))
                 for next_host in hosts_list:
                     puts("{0:<38}\t{1:<35}\t{2:<28}".format(
-                        blue(next_host['host']['name']),
-                        cyan(hgdict[next_host['host']['hostgroup_id']]),
+                        blue(next_host.name),
+                        cyan(hgdict[next_host.hostgroup_id]),
                         green(ts(reason))))
             return hosts_list
 
@@ -644,17 +815,14 @@ def rebuild(profile='', reason=False, wait='true', reserve='true', release='true
     :param release: Release the host at the end, default 'true'
     :param timeout: number of minutes to wait before failing
     """
-    frm = frm_cli.Foreman(foreman, (user, passwd))
+    frm = get_client(foreman, user, passwd)
     ## If no reason provided, assume that is user-made and add the reserved
     ## tag
     if not reason:
         reason = 'RESERVED'
-    hg2id = {}
-    for hg in frm.index_hostgroups(per_page=999):
-        hg2id[hg['hostgroup']['name']] = (
-            hg['hostgroup']['id'],
-            hg['hostgroup']['operatingsystem_id']
-        )
+    hostgroup = profile and get_hostgroup(frm, profile)
+    if profile and not hostgroup:
+        abort("Profile %s not found in foreman" % profile)
     up_query = add_hosts_to_query(hosts=[env.host])
     ## Mark the hosts as building and change the hostgroup if necessary,
     ## reboot
@@ -666,8 +834,9 @@ def rebuild(profile='', reason=False, wait='true', reserve='true', release='true
                           amount=1)
     new_host = {'build': True}
     if profile:
-        new_host['hostgroup_id'], new_host['operatingsystem_id'] = \
-            hg2id[profile]
+        new_host['hostgroup_id'] = hostgroup['hostgroup']['id']
+        new_host['operatingsystem_id'] = \
+            hostgroup['hostgroup']['operatingsystem_id']
     frm.update_hosts(id=env.host, host=new_host)
     ## force a reboot for the host to start building
     with settings(warn_only=True,
@@ -688,6 +857,195 @@ def rebuild(profile='', reason=False, wait='true', reserve='true', release='true
         frm.hosts_release(query=up_query)
 
 
+class BuildWatcher(object):
+    """
+    Watch the build status of many hosts from a single thread, with one
+    search for all the hosts that are still building, instead of each
+    worker polling its own host.
+
+    The hosts have to be added before forking the workers that wait for
+    them, those mark them as started and wait for them to be built with
+    :func:`wait_for_host_built`. The time between polls gets shorter as the
+    expected build time gets closer, from BUILD_POLL_MAX (60s) down to
+    BUILD_POLL_MIN (10s). The expected build time comes from the build
+    history (see :class:`BuildHistory`) or else the median of the builds
+    done, or else BUILD_EXPECTED_DURATION seconds (600 by default).
+
+    :param frm: Foreman client
+    :param profile: Profile the hosts are being built with
+    :param os_id: Id of the operating system of the profile
+    """
+    def __init__(self, frm, profile=None, os_id=None):
+        self.frm = frm
+        self.profile = profile
+        self.os_id = os_id
+        self.history = BuildHistory.from_env(env)
+        self.min_interval = float(env.get('BUILD_POLL_MIN', 10))
+        self.max_interval = float(env.get('BUILD_POLL_MAX', 60))
+        self.expected = float(env.get('BUILD_EXPECTED_DURATION', 600))
+        self.durations = {}
+        self._eta_msg = None
+        self._started = {}
+        self._built = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, host):
+        """
+        Start watching the given host
+        """
+        self._started[host] = multiprocessing.Value('d', 0)
+        self._built[host] = multiprocessing.Event()
+
+    def __contains__(self, host):
+        return host in self._built
+
+    def mark_started(self, host):
+        """
+        Called from the worker once the host is set to build
+        """
+        self._started[host].value = time.time()
+
+    def wait(self, host, deadline):
+        """
+        Wait until the host is built or the deadline (a timestamp) passes
+
+        :returns: True if the host was built
+        """
+        built = self._built[host]
+        ## wait in small steps, or it can't be interrupted
+        while not built.is_set() and time.time() < deadline:
+            built.wait(min(1, max(deadline - time.time(), 0)))
+        return built.is_set()
+
+    def _pending(self):
+        return [host for host, started in self._started.items()
+                if started.value and not self._built[host].is_set()]
+
+    def still_building(self, hosts):
+        """
+        Get which of the given hosts have the build flag set in foreman
+
+        :returns: set with the names of the hosts still building
+        """
+        try:
+            return set(bulk_call(
+                lambda query: [host['host']['name'] for host in iter_hosts(
+                    self.frm, search=query, fields=('name',))],
+                hosts, query='build = true'))
+        except frm_cli.ForemanException:
+            ## searching by build status not supported, one by one then
+            return set(host for host in hosts
+                       if self.frm.show_hosts(id=host)['host']['build'])
+
+    def poll(self):
+        """
+        Check all the hosts that are building, and wake up the workers
+        waiting for the ones that finished
+        """
+        pending = self._pending()
+        if not pending:
+            return
+        building = self.still_building(pending)
+        now = time.time()
+        for host in pending:
+            if host not in building:
+                self.durations[host] = now - self._started[host].value
+                self._built[host].set()
+        if self.durations:
+            durations = sorted(self.durations.values())
+            self.expected = durations[len(durations) / 2]
+        remaining = self._remaining()
+        eta_msg = remaining and "%d hosts still building, ETA %s" % (
+            len(remaining), _fmt_eta(max(remaining)))
+        ## only when it changes, the polls can be quite frequent
+        if eta_msg and eta_msg != self._eta_msg:
+            info(eta_msg)
+        self._eta_msg = eta_msg
+
+    def expected_for(self, host):
+        """
+        Expected build time of the given host, in seconds
+        """
+        if self.history:
+            expected = self.history.expected(profile=self.profile,
+                                             os_id=self.os_id, host=host)
+            if expected:
+                return expected
+        return self.expected
+
+    def _remaining(self):
+        now = time.time()
+        return [self.expected_for(host) - (now - self._started[host].value)
+                for host in self._pending()]
+
+    def next_interval(self):
+        """
+        Seconds to wait until the next poll, shorter the closer the pending
+        hosts are to the expected build time
+        """
+        remaining = self._remaining()
+        if not remaining:
+            ## nothing building yet, just check again soon
+            return 1
+        return max(self.min_interval,
+                   min(self.max_interval, min(remaining) / 2))
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception:
+                traceback.print_exc()
+            self._stop.wait(self.next_interval())
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop watching, and show the build durations
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        if self.history:
+            for host, duration in self.durations.iteritems():
+                self.history.record(self.profile, self.os_id, host, duration)
+        if self.durations:
+            info("Build durations: %s" % ', '.join(
+                '%s=%.0fs' % (host, duration) for host, duration
+                in sorted(self.durations.items(), key=lambda x: x[1])))
+
+
+def _fmt_eta(seconds):
+    if seconds <= 0:
+        return 'any time now'
+    if seconds < 60:
+        return '<1m'
+    return '~%dm' % round(seconds / 60.0)
+
+
+## The watcher of the current provision, inherited by the forked workers
+_BUILD_WATCHER = []
+
+
+def _wait_built_polling(frm, deadline):
+    """
+    Poll foreman for the build status of the current host until it's built
+    or the deadline passes, when there's no :class:`BuildWatcher`
+    """
+    interval = float(env.get('BUILD_POLL_MAX', 60))
+    while time.time() < deadline:
+        if frm.show_hosts(id=env.host)['host']['build'] is False:
+            return True
+        info("Waiting for %s to be built" % env.host)
+        time.sleep(max(min(interval, deadline - time.time()), 0))
+    return False
+
+
 @task
 @foreman_defaults
 def wait_for_host_built(timeout='30', foreman=None, user=None, passwd=None):
@@ -699,31 +1057,189 @@ def wait_for_host_built(timeout='30', foreman=None, user=None, passwd=None):
     :param passwd: Password to use when logging in
     :param timeout: number minutes to wait before failing
     """
-    frm = frm_cli.Foreman(foreman, (user, passwd))
+    frm = get_client(foreman, user, passwd)
+    deadline = time.time() + float(timeout) * 60
     info("Waiting for %s to be built" % env.host)
-    ## the number of loops is the amount of minutes to wait
-    for _ in range(int(timeout)):
-        new_status = frm.show_hosts(id=env.host)
-        if new_status['host']['build'] is False and test_ssh(env.host):
+    watcher = _BUILD_WATCHER and _BUILD_WATCHER[0]
+    if watcher and env.host in watcher:
+        watcher.mark_started(env.host)
+        built = watcher.wait(env.host, deadline)
+    else:
+        built = _wait_built_polling(frm, deadline)
+    while built:
+        if test_ssh(env.host):
             info("Host %s done" % env.host)
+            return True
+        if time.time() >= deadline:
             break
-        else:
-            if new_status['host']['build'] is True:
-                info("Waiting for %s to be built" % env.host)
-            else:
-                info("Waiting for %s to be reachable through ssh" % env.host)
-        time.sleep(60)
-    else:
-        raise BuildTimeout("Timeout while waiting for the host %s"
-                           % env.host)
-    return True
+        info("Waiting for %s to be reachable through ssh" % env.host)
+        time.sleep(max(min(10, deadline - time.time()), 0))
+    raise BuildTimeout("Timeout while waiting for the host %s" % env.host)
+
+
+def watch_builds(frm, hosts=(), profile=None, os_id=None):
+    """
+    Create and start the shared :class:`BuildWatcher`, watching the given
+    hosts
+
+    :param frm: Foreman client
+    :param hosts: list of host names to watch
+    :param profile: Profile the hosts are being built with
+    :param os_id: Id of the operating system of the profile
+    """
+    watcher = BuildWatcher(frm, profile=profile, os_id=os_id)
+    for host in hosts:
+        watcher.add(host)
+    watcher.start()
+    _BUILD_WATCHER[:] = [watcher]
+    return watcher
+
+
+def unwatch_builds():
+    """
+    Stop the shared :class:`BuildWatcher`
+    """
+    if _BUILD_WATCHER:
+        _BUILD_WATCHER.pop().stop()
+
+
+def default_build_timeout(profile, os_id, default):
+    """
+    Minutes to wait for a host to be built with the given profile, twice the
+    slowest recent builds of it
+
+    :param profile: Profile the hosts are being built with
+    :param os_id: Id of the operating system of the profile
+    :param default: Minutes to wait if there's no build history
+    """
+    history = BuildHistory.from_env(env)
+    slowest = history and history.timeout(profile=profile, os_id=os_id)
+    ## whole minutes, rounding up
+    return slowest and int(slowest + 59) / 60 or default
+
+
+def rebuild_all(frm, hostnames, os_id=None, **rebuild_kwargs):
+    """
+    Rebuild all the given hosts in parallel, watching their builds with a
+    shared :class:`BuildWatcher`
+
+    :param frm: Foreman client
+    :param hostnames: list of host names to rebuild
+    :param os_id: Id of the operating system of the profile
+    :param rebuild_kwargs: parameters to pass to the :func:`rebuild` task
+    :returns: dictionary with host -> rebuild result, like execute
+    """
+    ## so the workers don't have to discover the foreman version
+    prewarm(rebuild_kwargs['foreman'], rebuild_kwargs['user'],
+            rebuild_kwargs['passwd'])
+    watch_builds(frm, hostnames, profile=rebuild_kwargs.get('profile'),
+                 os_id=os_id)
+    try:
+        with settings(parallel=True,
+                      hosts=hostnames,
+                      warn_only=True,
+                      clean_revert=True):
+            return execute(rebuild, **rebuild_kwargs)
+    finally:
+        unwatch_builds()
+
+
+class RebuildPipeline(object):
+    """
+    Rebuild each host in its own process as soon as it's added, so the
+    hosts reserved first don't have to wait for the rest to be reserved
+
+    :param os_id: Id of the operating system of the profile
+    :param rebuild_kwargs: parameters to pass to the :func:`rebuild` task
+    """
+    def __init__(self, os_id=None, **rebuild_kwargs):
+        self.rebuild_kwargs = rebuild_kwargs
+        self.results = {}
+        self._procs = {}
+        self._queue = multiprocessing.Queue()
+        self.watcher = watch_builds(get_client(rebuild_kwargs['foreman'],
+                                               rebuild_kwargs['user'],
+                                               rebuild_kwargs['passwd']),
+                                    profile=rebuild_kwargs['profile'],
+                                    os_id=os_id)
+        ## so the workers don't have to discover the foreman version
+        prewarm(rebuild_kwargs['foreman'], rebuild_kwargs['user'],
+                rebuild_kwargs['passwd'])
+
+    def _rebuild(self, host):
+        try:
+            with settings(warn_only=True, clean_revert=True):
+                res = execute(rebuild, hosts=[host],
+                              **self.rebuild_kwargs)[host]
+        except BaseException as exc:
+            res = exc
+        try:
+            cPickle.dumps(res)
+        except Exception:
+            res = Exception(repr(res))
+        self._queue.put((host, res))
+
+    def add(self, host):
+        """
+        Start rebuilding the given host
+        """
+        info("Starting the rebuild of %s" % host)
+        self.watcher.add(host)
+        proc = multiprocessing.Process(target=self._rebuild, args=(host,),
+                                       name=host)
+        proc.start()
+        self._procs[host] = proc
+
+    def join(self):
+        """
+        Wait for all the rebuilds to finish
+
+        :returns: dictionary with host -> rebuild result, like execute
+        """
+        while len(self.results) < len(self._procs):
+            try:
+                host, res = self._queue.get(timeout=1)
+                self.results[host] = res
+            except Queue.Empty:
+                pass
+            for host, proc in self._procs.iteritems():
+                if (host not in self.results and not proc.is_alive()
+                        and proc.exitcode):
+                    self.results[host] = Exception(
+                        "Rebuild of %s exited with code %s"
+                        % (host, proc.exitcode))
+        for proc in self._procs.itervalues():
+            proc.join()
+        unwatch_builds()
+        return self.results
+
+    def abort(self):
+        """
+        Stop all the rebuilds that are still running, when not enough hosts
+        were reserved
+
+        Stopping the workers does not stop the installs already started on
+        the hosts, so those hosts must not be released.
+
+        :returns: set with the names of the hosts that are still building
+        """
+        for host, proc in self._procs.iteritems():
+            if proc.is_alive():
+                warn("Stopping the rebuild of %s" % host)
+                proc.terminate()
+        for proc in self._procs.itervalues():
+            proc.join()
+        unwatch_builds()
+        if not self._procs:
+            return set()
+        return self.watcher.still_building(self._procs.keys())
 
 
 @task(default=True)
 @runs_once
 @serial
 @foreman_defaults
-def provision(profile, query='', change_profile='false', force_rebuild='false', reason='', amount="0", outfile=None, add_tag='true', tries=300, timeout=60,  foreman=None, user=None, passwd=None):
+def provision(profile, query='', change_profile='false', force_rebuild='false', reason='', amount="0", outfile=None, add_tag='true', tries=300, timeout=60, pipeline='false', build_timeout='', foreman=None, user=None, passwd=None):
     """
     Provision the given host or hosts
 
@@ -736,9 +1252,17 @@ def provision(profile, query='', change_profile='false', force_rebuild='false',
     :param amount: Reserve only this amount of hosts
     :param outfile: Write the csv list of provisioned hosts in that file
     :param add_tag: Add the [UESR RESERVED] tag to the reason (true by default)
-    :param tries: Times to try in case of failure (300 by default)
-    :param timeout: How much time in seconds to wait between tries
-        (60 by default)
+    :param tries: Times to try in case of failure (300 by default), when
+        reserving it keeps trying for at least tries * timeout seconds
+    :param timeout: Max seconds to wait between tries (60 by default), the
+        reservation retries sooner, see RESERVE_BACKOFF_MIN
+    :param pipeline: Start rebuilding each host as soon as it's reserved,
+        instead of waiting to have all of them (false by default), if not
+        enough hosts are reserved the rebuilds are stopped, and the hosts
+        already installing are marked as unavailable instead of released
+    :param build_timeout: Minutes to wait for each host to be built, by
+        default twice the slowest recent builds of the profile, or the
+        timeout value if there's no build history
     :param foreman: URL to the foreman server
     :param user: username to login into Foreman
     :param passwd: Password to use when logging in
@@ -753,22 +1277,18 @@ def provision(profile, query='', change_profile='false', force_rebuild='false',
     tries = int(tries)
     while not frm and tries:
         try:
-            frm = frm_cli.Foreman(foreman, (user, passwd))
+            frm = get_client(foreman, user, passwd)
         except (ConnectionError, Timeout):
             error("Got an exception while trying to connect to foreman.")
             traceback.print_exc()
             info("Waiting %ds before retrying..." % timeout)
             time.sleep(timeout)
             tries -= 1
-    frm = frm_cli.Foreman(foreman, (user, passwd))
-    ## Get the hostgroup_name -> id mapping
-    hg2id = {}
-    for hg in frm.index_hostgroups(per_page=999):
-        hg2id[hg['hostgroup']['name']] = hg['hostgroup']['id']
     if not profile.startswith(env.PROVISION_GROUP_PREFIX):
         profile = env.PROVISION_GROUP_PREFIX + profile
     ## If the profile requested does not exist, throw error
-    if profile not in hg2id:
+    hostgroup = get_hostgroup(frm, profile)
+    if not hostgroup:
         error("Profile %s not found" % profile)
         show_profiles()
         return
@@ -778,6 +1298,22 @@ def provision(profile, query='', change_profile='false', force_rebuild='false',
     ## query to search other provisionable hosts
     query = '( %s ) AND hostgroup ~ %s%%' % (query,
                                              env.PROVISION_GROUP_PREFIX)
+    os_id = hostgroup['hostgroup']['operatingsystem_id']
+    demand = DemandHistory.from_env(env)
+    demand and demand.record(profile, amount)
+    build_timeout = build_timeout or default_build_timeout(profile, os_id,
+                                                           timeout)
+    if force_rebuild != 'false' or change_profile != 'false':
+        info("Waiting up to %s minutes for each build" % build_timeout)
+    rebuild_kwargs = dict(
+        foreman=foreman, user=user, passwd=passwd,
+        profile=profile,
+        reason="[PROVISIONING] %s" % reason,
+        wait='true',
+        reserve='true',
+        release='false',
+        timeout=build_timeout)
+    pipe = None
     #### get the available hosts  with the given profile ####
     hosts_list = []
     to_release = []
@@ -793,24 +1329,30 @@ def provision(profile, query='', change_profile='false', force_rebuild='false',
             other_prof_tries = 0
         try:
             info("Seeing if we have free hosts for the given profile.")
+            if pipeline != 'false' and force_rebuild != 'false':
+                pipe = RebuildPipeline(os_id=os_id, **rebuild_kwargs)
             hosts_list = _reserve(foreman=foreman, user=user, passwd=passwd,
                                   query=prof_query,
                                   reason='[QUEUED] %s' % reason,
                                   amount=amount, tries=same_prof_tries,
-                                  add_tag=add_tag, show=False)
+                                  add_tag=add_tag, show=False,
+                                  pipeline=pipe)
             if not hosts_list:
                 raise frm_cli.Unacceptable(None, None)
         except frm_cli.Unacceptable:
             if change_profile != 'false':
                 info("We were not, looking for free hosts outside the given "
                      "profile.")
+                pipe = None
+                if pipeline != 'false':
+                    pipe = RebuildPipeline(os_id=os_id, **rebuild_kwargs)
                 hosts_list = _reserve(foreman=foreman, user=user,
                                       passwd=passwd,
                                       query=query,
                                       reason='[QUEUED] %s' % reason,
                                       amount=amount, add_tag=add_tag,
                                       show=False, tries=other_prof_tries,
-                                      timeout=timeout)
+                                      timeout=timeout, pipeline=pipe)
                 force_rebuild = 'got hosts outside the profile'
     except Exception:
         traceback.print_exc()
@@ -824,21 +1366,16 @@ def provision(profile, query='', change_profile='false', force_rebuild='false',
             fail("Not enough hosts available.")
     info("########## Provisioning hosts")
     try:
-        if force_rebuild != 'false':
+        if force_rebuild != 'false' and pipe:
+            info("force_rebuild=%s, waiting for the rebuilds to finish."
+                 % force_rebuild)
+            res = pipe.join()
+            for host, out in res.iteritems():
+                print host, out
+        elif force_rebuild != 'false':
             info("force_rebuild=%s, rebuilding the hosts." % force_rebuild)
-            with settings(parallel=True,
-                          hosts=[h['host']['name'] for h in hosts_list],
-                          warn_only=True,
-                          clean_revert=True):
-                res = execute(
-                    rebuild,
-                    foreman=foreman, user=user, passwd=passwd,
-                    profile=profile,
-                    reason="[PROVISIONING] %s" % reason,
-                    wait='true',
-                    reserve='true',
-                    release='false',
-                    timeout=timeout)
+            res = rebuild_all(frm, [h.name for h in hosts_list],
+                              os_id=os_id, **rebuild_kwargs)
             for host, out in res.iteritems():
                 print host, out
         else:
@@ -848,9 +1385,9 @@ def provision(profile, query='', change_profile='false', force_rebuild='false',
     ## Finish
     ############################
         info(green("########## Everything went perfect."))
-        hostnames = [h['host']['name'] for h in hosts_list]
-        frm.update_reserved_reason(query=add_hosts_to_query(hosts=hostnames),
-                                   reason=ts(reason))
+        hostnames = [h.name for h in hosts_list]
+        set_state(frm.update_reserved_reason, hostnames, 'PROVISIONED',
+                  reason=ts(reason))
         if outfile:
             with open(outfile, 'w') as ofd:
                 ofd.write(','.join(hostnames))
@@ -859,9 +1396,94 @@ def provision(profile, query='', change_profile='false', force_rebuild='false',
         pass
     finally:
         info('########## Cleaning up...')
+        if state.output.debug:
+            info("Foreman client stats: %s" % client_stats())
         if to_release:
             error("Some hosts failed to build, releasing the healthy ones.")
-            to_release = [h['host']['name'] for h in to_release]
+            to_release = [h.name for h in to_release]
             info("\tReleasing: %s" % to_release)
-            frm.hosts_release(query=add_hosts_to_query(hosts=to_release))
+            set_state(frm.hosts_release, to_release, 'RELEASED')
             fail("Some hosts failed to build.")
+
+
+@runs_once
+@task
+@foreman_defaults
+def warm_pool(size='', profiles='', days='', dry_run='false', foreman=None, user=None, passwd=None):
+    """
+    Keep some hosts already built and available for the profiles that get
+    the most provision requests, so those requests don't have to wait for
+    any rebuild. The hosts are taken from the free hosts of the other
+    profiles.
+
+    Meant to be run periodically, for example from cron.
+
+    :param size: Max number of available hosts to keep per profile,
+        WARM_POOL_SIZE from the fabricrc file or 2 by default
+    :param profiles: Max number of profiles to keep hosts for,
+        WARM_POOL_PROFILES or 5 by default
+    :param days: Days of provision requests to take into account,
+        WARM_POOL_DAYS or 7 by default
+    :param dry_run: Only show what would be done (false by default)
+    :param foreman: URL to the foreman server
+    :param user: username to login into Foreman
+    :param passwd: Password to use when logging in
+    """
+    if 'PROVISION_GROUP_PREFIX' not in env:
+        fail("Please set up PROVISION_GROUP_PREFIX in the fabricrc file")
+    size = int(size or env.get('WARM_POOL_SIZE', 2))
+    profiles = int(profiles or env.get('WARM_POOL_PROFILES', 5))
+    days = float(days or env.get('WARM_POOL_DAYS', 7))
+    demand = DemandHistory.from_env(env)
+    hot = demand and demand.hot_profiles(since=time.time() - days * 86400,
+                                         max_profiles=profiles,
+                                         max_size=size)
+    if not hot:
+        info("No provision requests in the last %s days, nothing to do"
+             % days)
+        return
+    frm = get_client(foreman, user, passwd)
+    ## never take hosts from the other hot profiles
+    donors_query = 'hostgroup ~ %s%%' % env.PROVISION_GROUP_PREFIX \
+        + ''.join(' AND hostgroup != %s' % profile for profile, _ in hot)
+    for profile, target in hot:
+        hostgroup = get_hostgroup(frm, profile)
+        if not hostgroup:
+            warn("Profile %s does not exist anymore, skipping" % profile)
+            continue
+        os_id = hostgroup['hostgroup']['operatingsystem_id']
+        available = len(frm.show_available(query='hostgroup=%s' % profile,
+                                           amount=target) or [])
+        missing = target - available
+        info("Profile %s: %d hosts available of %d wanted"
+             % (profile, available, target))
+        if missing <= 0:
+            continue
+        donors = len(frm.show_available(query=donors_query, amount=missing)
+                     or [])
+        if not donors:
+            warn("No free hosts in other profiles to warm %s" % profile)
+            continue
+        if dry_run != 'false':
+            info("Would rebuild %d hosts with profile %s"
+                 % (min(missing, donors), profile))
+            continue
+        hosts_list = _reserve(foreman=foreman, user=user, passwd=passwd,
+                              query=donors_query,
+                              reason='[WARM_POOL] %s' % profile,
+                              amount=min(missing, donors), tries=1,
+                              add_tag='false', show=False)
+        if not hosts_list:
+            continue
+        res = rebuild_all(frm, [h.name for h in hosts_list],
+                          os_id=os_id,
+                          foreman=foreman, user=user, passwd=passwd,
+                          profile=profile,
+                          reason='[WARM_POOL] %s' % profile,
+                          wait='true',
+                          reserve='true',
+                          release='true',
+                          timeout=default_build_timeout(
+                              profile, os_id, 120))
+        for host, out in res.iteritems():
+            print host, out
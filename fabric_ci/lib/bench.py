@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+#encoding: utf-8
+"""
+Benchmarks for the helpers in fabric_ci.lib, they do not need any real host
+to connect to.
+
+Usage:
+    python fabric_ci/lib/bench.py backends [num_hosts] [pool_size]
+    python fabric_ci/lib/bench.py show_hosts [num_hosts] [latency_ms]
+    python fabric_ci/lib/bench.py ages [num_hosts]
+    python fabric_ci/lib/bench.py records [num_hosts]
+
+The memory is measured as the proportional set size (linux only) of the
+benchmark process and all its children.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import threading
+import subprocess
+
+PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+## replace this script's dir, or lib/foreman.py would shadow the foreman
+## client package
+sys.path[0] = PATH
+
+
+def _noop_task():
+    """
+    Simulate a cheap remote command
+    """
+    time.sleep(0.01)
+    return True
+
+
+def _pss_kb(pid):
+    """
+    Proportional set size of the given process, so the pages shared after
+    forking are not counted more than once
+    """
+    try:
+        with open('/proc/%s/smaps_rollup' % pid) as smaps:
+            for line in smaps:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return 0
+
+
+def _children(pid):
+    children = []
+    for proc in os.listdir('/proc'):
+        if not proc.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % proc) as stat:
+                ppid = stat.read().rsplit(')', 1)[1].split()[1]
+        except IOError:
+            continue
+        if ppid == str(pid):
+            children.append(proc)
+    return children
+
+
+class MemorySampler(threading.Thread):
+    """
+    Keeps the peak of the memory used by this process and its children
+    """
+    def __init__(self, interval=0.05):
+        super(MemorySampler, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.peak_kb = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        pid = os.getpid()
+        while not self._stop_event.is_set():
+            used = _pss_kb(pid) + sum(_pss_kb(child)
+                                      for child in _children(pid))
+            self.peak_kb = max(self.peak_kb, used)
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        return self.peak_kb
+
+
+def _run_backend(backend, num_hosts, pool_size):
+    """
+    Run the noop task in parallel with the given backend, has to run in a
+    fresh process to get meaningful memory usage values
+    """
+    import fabric
+    from fabric.api import execute, env, parallel, hide
+    from fabric_ci.lib.parallel import monkey_patch
+    monkey_patch(fabric)
+    env.PARALLEL_BACKEND = backend
+    task = parallel(pool_size=pool_size)(_noop_task)
+    hosts = ['bench%05d' % num for num in range(num_hosts)]
+    sampler = MemorySampler()
+    sampler.start()
+    start = time.time()
+    with hide('everything'):
+        execute(task, hosts=hosts)
+    elapsed = time.time() - start
+    print json.dumps({
+        'backend': backend,
+        'hosts_per_sec': num_hosts / elapsed,
+        'elapsed': elapsed,
+        'peak_mem_kb': sampler.stop(),
+    })
+
+
+def backends(num_hosts=1000, pool_size=100):
+    """
+    Compare the process and thread backends of the parallel runner
+    """
+    num_hosts, pool_size = int(num_hosts), int(pool_size)
+    print "%d hosts, pool size %d" % (num_hosts, pool_size)
+    print "%-10s %12s %10s %16s" % ('backend', 'hosts/s', 'seconds',
+                                    'peak mem (MB)')
+    for backend in ('process', 'thread'):
+        out = subprocess.Popen(
+            [sys.executable, __file__, '_backend', backend, str(num_hosts),
+             str(pool_size)],
+            stdout=subprocess.PIPE,
+            stderr=open(os.devnull, 'w')).communicate()[0]
+        res = json.loads(out.strip().splitlines()[-1])
+        print "%-10s %12.1f %10.2f %16.1f" % (backend,
+                                              res['hosts_per_sec'],
+                                              res['elapsed'],
+                                              res['peak_mem_kb'] / 1024.0)
+
+
+class FakeForeman(object):
+    """
+    Foreman client lookalike that serves synthetic hosts, counting the
+    requests and sleeping latency seconds on each of them to simulate the
+    round trip to the server
+    """
+    def __init__(self, num_hosts, latency=0.02, unlisted=0.05):
+        self.url = 'http://fake-foreman'
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.hosts = {}
+        for num in range(num_hosts):
+            reserved = num % 2 and 'RESERVED' or 'false'
+            self.hosts[num] = {'host': {
+                'id': num,
+                'name': 'host%05d.example.com' % num,
+                'hostgroup_id': num % 10,
+                'host_parameters': [{'host_parameter': {
+                    'name': 'RESERVED',
+                    'value': reserved,
+                    'updated_at': '2014-01-01T00:00:00Z',
+                }}],
+            }}
+        ## some hosts are not handled by the reserve plugin
+        self.unlisted = set(range(0, num_hosts, int(1 / unlisted)))
+
+    def _request(self):
+        with self._lock:
+            self.requests += 1
+        time.sleep(self.latency)
+
+    def _search(self, query):
+        names = set(re.findall(r'name=([^\s)]+)', query))
+        return [host for host in self.hosts.itervalues()
+                if not names or host['host']['name'] in names]
+
+    def index_hosts(self, search='', per_page=20, page=1):
+        self._request()
+        return [{'host': dict((key, val)
+                              for key, val in host['host'].iteritems()
+                              if key != 'host_parameters')}
+                for host in self._search(search)]
+
+    def show_hosts(self, host_id):
+        self._request()
+        return self.hosts[host_id]
+
+    def _plugin_hosts(self, query, reserved):
+        self._request()
+        return [host for host in self._search(query)
+                if host['host']['id'] not in self.unlisted
+                and (host['host']['host_parameters'][0]['host_parameter']
+                     ['value'] != 'false') == reserved]
+
+    def show_reserved(self, query=''):
+        return self._plugin_hosts(query, True)
+
+    def show_available(self, query='', amount=0):
+        return self._plugin_hosts(query, False)
+
+
+def show_hosts(num_hosts=500, latency_ms=20):
+    """
+    Compare getting the host parameters one show_hosts request at a time
+    against the batched show_hosts_details
+    """
+    from fabric_ci.lib.foreman import show_hosts_details
+    num_hosts, latency = int(num_hosts), float(latency_ms) / 1000
+    print "%d hosts, %.0fms per request" % (num_hosts, latency * 1000)
+    print "%-10s %10s %10s" % ('method', 'requests', 'seconds')
+    for method in ('serial', 'batched'):
+        frm = FakeForeman(num_hosts, latency=latency)
+        start = time.time()
+        hosts = frm.index_hosts(search='', per_page=999)
+        if method == 'serial':
+            hosts = [frm.show_hosts(host['host']['id']) for host in hosts]
+        else:
+            hosts = show_hosts_details(frm, hosts)
+        assert len(hosts) == num_hosts
+        assert all('host_parameters' in host['host'] for host in hosts)
+        print "%-10s %10d %10.2f" % (method, frm.requests,
+                                     time.time() - start)
+
+
+def _strftime_age(host):
+    """
+    Age of the reservation of a host the way is_stuck used to get it
+    """
+    import datetime
+    for param in host['host']['host_parameters']:
+        if param['host_parameter']['name'].lower() == 'reserved':
+            updated = int(datetime.datetime.strptime(
+                param['host_parameter']['updated_at'],
+                '%Y-%m-%dT%H:%M:%SZ').strftime('%s'))
+            return int(datetime.datetime.now().strftime('%s')) - updated
+
+
+def ages(num_hosts=10000):
+    """
+    Compare getting the age of the reservations host by host with strptime
+    against the fixed format parsing of reservation_ages
+    """
+    from fabric_ci.lib.inventory import reservation_ages
+    num_hosts = int(num_hosts)
+    hosts = FakeForeman(num_hosts).hosts.values()
+    for num, host in enumerate(hosts):
+        host['host']['host_parameters'][0]['host_parameter']['updated_at'] \
+            = time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                            time.gmtime(1400000000 + num * 3607))
+    print "%d hosts" % num_hosts
+    print "%-10s %10s %14s" % ('method', 'seconds', 'us per host')
+    for method, func in (
+            ('strptime', lambda: [_strftime_age(host) for host in hosts]),
+            ('sliced', lambda: reservation_ages(hosts))):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        print "%-10s %10.3f %14.1f" % (method, elapsed,
+                                       elapsed * 1e6 / num_hosts)
+
+
+def _host_json(num):
+    """
+    A host as the api returns it, with all the fields even if we don't use
+    most of them
+    """
+    host = {
+        'id': num,
+        'name': 'host%05d.example.com' % num,
+        'hostgroup_id': num % 10,
+        'created_at': '2013-01-01T00:00:00Z',
+        'updated_at': '2014-01-01T00:00:00Z',
+        'host_parameters': [{'host_parameter': {
+            'name': name,
+            'value': value,
+            'created_at': '2013-01-01T00:00:00Z',
+            'updated_at': '2014-01-01T00:00:00Z',
+            'id': num * 10 + index,
+            'reference_id': num,
+        }} for index, (name, value) in enumerate((
+            ('RESERVED', num % 2 and '[USER_RESERVED] testing' or 'false'),
+            ('ssh_port', '22'),
+            ('ntp_server', 'clock.example.com')))],
+    }
+    for index, field in enumerate((
+            'architecture_id', 'domain_id', 'environment_id', 'medium_id',
+            'model_id', 'operatingsystem_id', 'owner_id', 'ptable_id',
+            'puppet_proxy_id', 'subnet_id', 'compute_resource_id')):
+        host[field] = num % (index + 3)
+    host.update({
+        'ip': '10.%d.%d.%d' % (num >> 16, (num >> 8) & 255, num & 255),
+        'mac': '52:54:00:%02x:%02x:%02x' % (num >> 16, (num >> 8) & 255,
+                                            num & 255),
+        'certname': 'host%05d.example.com' % num,
+        'uuid': '%032x' % num,
+        'comment': '',
+        'owner_type': 'User',
+        'build': False,
+        'enabled': True,
+        'managed': True,
+        'last_report': '2014-01-01T00:00:00Z',
+        'last_compile': '2014-01-01T00:00:00Z',
+        'puppet_status': 0,
+    })
+    return {'host': host}
+
+
+def _run_records(form, num_hosts):
+    """
+    Load the hosts from json in the given form, has to run in a fresh
+    process to get meaningful memory usage values
+    """
+    import gc
+    from fabric_ci.lib.inventory import host_record
+    ## one response per page, like iter_pages gets them
+    pages = [json.dumps([_host_json(num) for num in range(
+        first, min(first + 100, num_hosts))])
+             for first in range(0, num_hosts, 100)]
+    gc.collect()
+    before = _pss_kb(os.getpid())
+    start = time.time()
+    hosts = []
+    for page in pages:
+        if form == 'record':
+            hosts.extend(host_record(host) for host in json.loads(page))
+        else:
+            hosts.extend(json.loads(page))
+    gc.collect()
+    print json.dumps({
+        'form': form,
+        'elapsed': time.time() - start,
+        'mem_kb': _pss_kb(os.getpid()) - before,
+        'hosts': len(hosts),
+    })
+
+
+def records(num_hosts=5000):
+    """
+    Compare the memory used to keep the hosts as the api returns them
+    against keeping them as HostRecords
+    """
+    num_hosts = int(num_hosts)
+    print "%d hosts" % num_hosts
+    print "%-10s %10s %12s %14s" % ('form', 'seconds', 'mem (MB)',
+                                    'bytes per host')
+    for form in ('dict', 'record'):
+        out = subprocess.Popen(
+            [sys.executable, __file__, '_records', form, str(num_hosts)],
+            stdout=subprocess.PIPE).communicate()[0]
+        res = json.loads(out.strip().splitlines()[-1])
+        print "%-10s %10.2f %12.1f %14d" % (
+            form, res['elapsed'], res['mem_kb'] / 1024.0,
+            res['mem_kb'] * 1024 / num_hosts)
+
+
+def main(args):
+    if not args:
+        print __doc__
+        return 1
+    if args[0] == '_backend':
+        _run_backend(args[1], int(args[2]), int(args[3]))
+    elif args[0] == '_records':
+        _run_records(args[1], int(args[2]))
+    else:
+        globals()[args[0]](*args[1:])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,9 +1,33 @@
 #!/usr/bin/env python
 #encoding: utf-8
+import os
+import sys
+import Queue
+import json
+import time
+import hashlib
+import threading
 from functools import wraps
+from multiprocessing.pool import ThreadPool
 from fabric.api import env
+from fabric.utils import abort
 from getpass import getpass
-from fabric_ci.lib.utils import check_param
+from fabric_ci.lib.utils import check_param, absolute_import
+
+## To avoid collisions with this module
+frm_cli = absolute_import('foreman.client', ['Foreman'])
+
+
+## Foreman clients (and their http sessions) by process, server and user
+_CLIENTS = {}
+## Foreman versions by server, to skip the version discovery request when
+## creating new clients (for example after forking)
+_VERSIONS = {}
+_CLIENTS_LOCK = threading.Lock()
+_CLIENT_STATS = {
+    'created': 0,
+    'reused': 0,
+}
 
 
 def foreman_defaults(func):
@@ -27,3 +51,443 @@ def foreman_defaults(func):
         kwargs['passwd'] = kwargs.get('passwd', env.FOREMAN_PASSWORD)
         return func(*args, **kwargs)
     return newfunc
+
+
+def _pool_size(session, pool_size):
+    """
+    Allow as many keep-alive connections as concurrent users of the client
+    """
+    try:
+        from requests.adapters import HTTPAdapter
+    except ImportError:
+        ## requests < 1.0, keeps the default pool
+        return
+    for prefix in ('http://', 'https://'):
+        session.mount(prefix, HTTPAdapter(pool_connections=1,
+                                          pool_maxsize=pool_size))
+
+
+def get_client(foreman, user=None, passwd=None, pool_size=10):
+    """
+    Get a foreman client for the given server and user, reusing the one
+    already created in this same process if any, so its http connections
+    are kept alive between tasks instead of doing the handshakes and the
+    version discovery each time.
+
+    The clients are not shared between processes, as the connections would
+    be, but the parent's version discovery is, so calling this before
+    forking (:func:`prewarm`) saves a request on each child.
+
+    :param foreman: URL to the foreman server
+    :param user: username to login into Foreman, None to not authenticate
+    :param passwd: Password to use when logging in
+    :param pool_size: Max number of keep-alive connections to the server
+    """
+    key = (os.getpid(), foreman, user, passwd)
+    with _CLIENTS_LOCK:
+        if key in _CLIENTS:
+            _CLIENT_STATS['reused'] += 1
+            return _CLIENTS[key]
+    auth = user and (user, passwd) or None
+    client = frm_cli.Foreman(foreman, auth, version=_VERSIONS.get(foreman))
+    _pool_size(client.session, pool_size)
+    with _CLIENTS_LOCK:
+        _VERSIONS[foreman] = client.version
+        _CLIENT_STATS['created'] += 1
+        return _CLIENTS.setdefault(key, client)
+
+
+def prewarm(foreman, user=None, passwd=None):
+    """
+    Create the client for the given server before forking, see
+    :func:`get_client`
+    """
+    return get_client(foreman, user, passwd)
+
+
+def client_stats():
+    """
+    Counters of the clients and http connections created and reused by this
+    process
+    """
+    stats = dict(_CLIENT_STATS)
+    stats['connections'] = 0
+    stats['requests'] = 0
+    for (pid, _, _, _), client in _CLIENTS.items():
+        if pid != os.getpid():
+            continue
+        for adapter in getattr(client.session, 'adapters', {}).values():
+            pools = getattr(adapter, 'poolmanager', None)
+            if pools is None:
+                continue
+            for pool_key in pools.pools.keys():
+                pool = pools.pools[pool_key]
+                stats['connections'] += getattr(pool, 'num_connections', 0)
+                stats['requests'] += getattr(pool, 'num_requests', 0)
+    stats['connections_reused'] = max(0,
+                                      stats['requests']
+                                      - stats['connections'])
+    return stats
+
+
+class ForemanCache(object):
+    """
+    Cache for the foreman metadata that rarely changes (like the hostgroups),
+    kept in memory and, if a cache dir is given, on disk so it's shared
+    between runs. The forked parallel workers inherit the memory one.
+
+    Configured from the fabricrc file:
+        FOREMAN_CACHE_TTL = 300   (seconds, 0 disables the cache)
+        FOREMAN_CACHE_DIR = ~/.cache/fabric_ci
+    """
+    def __init__(self, ttl=300, cache_dir=None):
+        self.ttl = float(ttl)
+        self.cache_dir = cache_dir and os.path.expanduser(cache_dir)
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir,
+                            hashlib.md5(repr(key)).hexdigest() + '.json')
+
+    def _load(self, key):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._path(key)) as cache_fd:
+                entry = json.load(cache_fd)
+        except (IOError, ValueError):
+            return None
+        return entry['timestamp'], entry['value']
+
+    def _save(self, key, entry):
+        if not self.cache_dir:
+            return
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        ## write and rename, so other runs never read half written files
+        tmp_path = '%s.%d' % (self._path(key), os.getpid())
+        with open(tmp_path, 'w') as cache_fd:
+            json.dump({'timestamp': entry[0], 'value': entry[1]}, cache_fd)
+        os.rename(tmp_path, self._path(key))
+
+    def get(self, key, loader):
+        """
+        Get the value for the given key, calling the loader if it's not
+        cached or it expired
+
+        :param key: tuple of strings that identifies the value
+        :param loader: function that returns the value to cache
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or now - entry[0] > self.ttl:
+                entry = self._load(key)
+            if entry is not None and now - entry[0] <= self.ttl:
+                self._entries[key] = entry
+                return entry[1]
+        entry = (now, loader())
+        if self.ttl > 0:
+            with self._lock:
+                self._entries[key] = entry
+                self._save(key, entry)
+        return entry[1]
+
+    def invalidate(self, key=None):
+        """
+        Drop the given key from the cache, or everything if none given
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+            if not self.cache_dir or not os.path.isdir(self.cache_dir):
+                return
+            if key is None:
+                paths = [os.path.join(self.cache_dir, fname)
+                         for fname in os.listdir(self.cache_dir)
+                         if fname.endswith('.json')]
+            else:
+                paths = [self._path(key)]
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+_CACHE = []
+
+
+def foreman_cache():
+    """
+    Shared :class:`ForemanCache`, configured from env on first use
+    """
+    if not _CACHE:
+        _CACHE.append(ForemanCache(
+            ttl=env.get('FOREMAN_CACHE_TTL', 300),
+            cache_dir=env.get('FOREMAN_CACHE_DIR', None)))
+    return _CACHE[0]
+
+
+def _cache_key(frm, name):
+    auth = frm.session.auth
+    return (name, frm.url, auth and auth[0] or None)
+
+
+def get_hostgroups(frm):
+    """
+    List of all the hostgroups as returned by index_hostgroups, cached
+
+    :param frm: Foreman client
+    """
+    return foreman_cache().get(_cache_key(frm, 'hostgroups'),
+                               lambda: list(iter_hostgroups(frm)))
+
+
+class HostgroupNames(dict):
+    """
+    Dictionary with the hostgroup id -> name mapping, from the cache. If an
+    id is missing the hostgroup might be newer than the cache, so the
+    hostgroups are fetched again (only once), and if it's still missing it
+    aborts.
+    """
+    def __init__(self, frm):
+        super(HostgroupNames, self).__init__(
+            (hg['hostgroup']['id'], hg['hostgroup']['name'])
+            for hg in get_hostgroups(frm))
+        self.frm = frm
+        self.refreshed = False
+
+    def __missing__(self, gid):
+        if not self.refreshed:
+            self.refreshed = True
+            invalidate_hostgroups(self.frm)
+            self.update(HostgroupNames(self.frm))
+            if gid in self:
+                return self[gid]
+        abort("Hostgroup with id %s not found in foreman" % gid)
+
+
+def hostgroup_names(frm):
+    """
+    Dictionary with the hostgroup id -> name mapping, from the cache, see
+    :class:`HostgroupNames`
+
+    :param frm: Foreman client
+    """
+    return HostgroupNames(frm)
+
+
+def get_hostgroup(frm, name):
+    """
+    Get the hostgroup with the given name from the cache, fetching the
+    hostgroups again if it's not there, as it might be newer than the cache
+
+    :param frm: Foreman client
+    :param name: Name of the hostgroup
+    :returns: The hostgroup as returned by index_hostgroups, None if it does
+        not exist
+    """
+    for refresh in (False, True):
+        if refresh:
+            invalidate_hostgroups(frm)
+        for hg in get_hostgroups(frm):
+            if hg['hostgroup']['name'] == name:
+                return hg
+    return None
+
+
+def invalidate_hostgroups(frm=None):
+    """
+    Drop the cached hostgroups of the given client's server, or all of them
+
+    :param frm: Foreman client
+    """
+    if frm is None:
+        foreman_cache().invalidate()
+    else:
+        foreman_cache().invalidate(_cache_key(frm, 'hostgroups'))
+
+
+## Max number of hosts to put in a single search query, to keep the urls
+## short enough for the server
+SEARCH_CHUNK = 100
+MAX_WAIT = 60 * 60 * 24
+
+
+def hosts_query(hosts, query=''):
+    """
+    Build a foreman query that matches any of the given host names, and the
+    given query if any
+
+    :param hosts: list of host names
+    :param query: Extra query the hosts must match
+    """
+    hosts_part = '( name=' + ' OR name='.join(hosts) + ' )'
+    if not query:
+        return hosts_part
+    return query + ' AND ' + hosts_part
+
+
+def bulk_call(method, hosts, query='', **kwargs):
+    """
+    Call a foreman client method that takes a query (like the reserve plugin
+    ones) for all the given hosts, in chunks of FOREMAN_BULK_CHUNK hosts
+    (SEARCH_CHUNK by default), running up to FOREMAN_BULK_WORKERS of them at
+    the same time (4 by default)
+
+    :param method: Foreman client method, like frm.hosts_release
+    :param hosts: list of host names
+    :param query: Extra query the hosts must match
+    :param kwargs: Any other parameters for the method
+    :returns: All the elements returned by the method calls, concatenated
+    """
+    chunk = int(env.get('FOREMAN_BULK_CHUNK', SEARCH_CHUNK))
+    workers = int(env.get('FOREMAN_BULK_WORKERS', 4))
+    queries = [hosts_query(hosts[start:start + chunk], query)
+               for start in range(0, len(hosts), chunk)]
+
+    def call(chunk_query):
+        return method(query=chunk_query, **kwargs) or []
+
+    if len(queries) < 2 or workers < 2:
+        results = [call(chunk_query) for chunk_query in queries]
+    else:
+        pool = ThreadPool(min(workers, len(queries)))
+        try:
+            results = pool.map_async(call, queries).get(timeout=MAX_WAIT)
+        finally:
+            pool.close()
+    return [elem for result in results for elem in result]
+
+
+def has_parameters(host):
+    """
+    Check if the given host record includes its parameters
+    """
+    return 'host_parameters' in host['host'] or 'parameters' in host['host']
+
+
+def show_hosts_details(frm, hosts, pool_size=10):
+    """
+    Get the full records (with the parameters) of the given hosts in as few
+    requests as possible. The reserve plugin listings already include the
+    parameters, so it first gets the hosts from them in chunks of
+    SEARCH_CHUNK names, and only the hosts not found there are fetched one
+    by one, pool_size of them at a time.
+
+    :param frm: Foreman client
+    :param hosts: list of host records as returned by index_hosts
+    :param pool_size: Max number of concurrent show_hosts requests
+    :returns: list of full host records, in the same order
+    """
+    by_id = dict((host['host']['id'], host) for host in hosts
+                 if has_parameters(host))
+    missing = [host for host in hosts if host['host']['id'] not in by_id]
+    for start in range(0, len(missing), SEARCH_CHUNK):
+        names = [host['host']['name']
+                 for host in missing[start:start + SEARCH_CHUNK]]
+        query = hosts_query(names)
+        for method in ('show_reserved', 'show_available'):
+            if not hasattr(frm, method):
+                continue
+            for host in getattr(frm, method)(query=query) or []:
+                if has_parameters(host):
+                    by_id[host['host']['id']] = host
+    missing = [host['host']['id'] for host in hosts
+               if host['host']['id'] not in by_id]
+    if missing:
+        pool = ThreadPool(min(pool_size, len(missing)))
+        try:
+            for host in pool.map(frm.show_hosts, missing):
+                by_id[host['host']['id']] = host
+        finally:
+            pool.close()
+    return [by_id[host['host']['id']] for host in hosts]
+
+
+def _put(pages, item, stop):
+    while not stop.is_set():
+        try:
+            pages.put(item, timeout=0.1)
+            return
+        except Queue.Full:
+            continue
+
+
+def iter_pages(method, per_page=None, prefetch=2, **params):
+    """
+    Lazily iterate over all the elements of an index api call, page by page,
+    while the next pages are fetched in the background.
+
+    :param method: Foreman client index method, like frm.index_hosts
+    :param per_page: Elements per page, FOREMAN_PAGE_SIZE from the fabricrc
+        file or 100 by default
+    :param prefetch: Max number of pages fetched ahead
+    :param params: Extra parameters for the index method, like search
+    """
+    per_page = int(per_page or env.get('FOREMAN_PAGE_SIZE', 100))
+    pages = Queue.Queue(maxsize=max(int(prefetch), 1))
+    stop = threading.Event()
+
+    def fetch():
+        page = 1
+        while not stop.is_set():
+            try:
+                results = method(per_page=per_page, page=page, **params)
+            except Exception:
+                _put(pages, (None, sys.exc_info()), stop)
+                return
+            ## newer api versions wrap the elements
+            if isinstance(results, dict):
+                results = results.get('results', [])
+            _put(pages, (results, None), stop)
+            if len(results) < per_page:
+                return
+            page += 1
+
+    fetcher = threading.Thread(target=fetch)
+    fetcher.daemon = True
+    fetcher.start()
+    try:
+        while True:
+            try:
+                results, exc_info = pages.get(timeout=1)
+            except Queue.Empty:
+                continue
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            for elem in results:
+                yield elem
+            if len(results) < per_page:
+                return
+    finally:
+        stop.set()
+
+
+def iter_hosts(frm, search=None, fields=None, **kwargs):
+    """
+    Lazily iterate over all the hosts that match the search, see
+    :func:`iter_pages`
+
+    :param frm: Foreman client
+    :param search: Foreman search string
+    :param fields: If given, only keep those fields of each host
+    """
+    for host in iter_pages(frm.index_hosts, search=search, **kwargs):
+        if fields:
+            host = {'host': dict((field, host['host'].get(field))
+                                 for field in fields)}
+        yield host
+
+
+def iter_hostgroups(frm, search=None, **kwargs):
+    """
+    Lazily iterate over all the hostgroups that match the search, see
+    :func:`iter_pages`
+
+    :param frm: Foreman client
+    :param search: Foreman search string
+    """
+    return iter_pages(frm.index_hostgroups, search=search, **kwargs)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+#encoding: utf-8
+"""
+Local history of the host build durations, used to guess how long the next
+builds will take.
+
+The builds are appended to a tab separated file, one line per build, and a
+small summary with the latest durations per profile, operating system and
+host is kept next to it. The summary remembers up to where the file was
+read, so querying only reads the builds added since the last time, no
+matter how old the history is.
+"""
+import os
+import json
+import time
+from fabric_ci.lib.utils import warn, percentile
+
+## Number of durations per profile, os and host kept in the summary
+KEEP = 50
+
+
+class BuildHistory(object):
+    """
+    :param path: Path to the history file, the summary is stored in the same
+        path with the .summary extension
+    """
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.summary_path = self.path + '.summary'
+        self._summary = None
+
+    @classmethod
+    def from_env(cls, env):
+        """
+        Get the history at BUILD_HISTORY from the fabricrc file, by default
+        ~/.fabric_ci/build_history, set it to an empty value to disable it
+        """
+        path = env.get('BUILD_HISTORY', '~/.fabric_ci/build_history')
+        return path and cls(path) or None
+
+    def record(self, profile, os_id, host, duration, when=None):
+        """
+        Append a build to the history
+
+        :param profile: Hostgroup the host was built with
+        :param os_id: Id of the operating system the host was built with
+        :param host: Host name
+        :param duration: Seconds the build took
+        :param when: Timestamp of the end of the build, now by default
+        """
+        line = '%d\t%s\t%s\t%s\t%.1f\n' % (when or time.time(), profile,
+                                           os_id, host, duration)
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            ## a single small write in append mode, so concurrent runs don't
+            ## mix their lines
+            with open(self.path, 'a') as hist_fd:
+                hist_fd.write(line)
+        except (IOError, OSError) as exc:
+            warn("Unable to store the build history: %s" % exc)
+
+    def _load(self):
+        summary = {'offset': 0, 'durations': {}}
+        try:
+            with open(self.summary_path) as summary_fd:
+                summary = json.load(summary_fd)
+        except (IOError, ValueError):
+            pass
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return summary
+        if size < summary['offset']:
+            ## the history was truncated or replaced, start again
+            summary = {'offset': 0, 'durations': {}}
+        if size == summary['offset']:
+            return summary
+        durations = summary['durations']
+        with open(self.path) as hist_fd:
+            hist_fd.seek(summary['offset'])
+            for line in hist_fd:
+                ## skip a line that is still being written
+                if not line.endswith('\n'):
+                    break
+                summary['offset'] += len(line)
+                try:
+                    _, profile, os_id, host, duration = \
+                        line.rstrip('\n').split('\t')
+                    duration = float(duration)
+                except ValueError:
+                    continue
+                for key in ('profile:' + profile, 'os:' + os_id,
+                            'host:%s/%s' % (profile, host)):
+                    durations[key] = (durations.get(key, []) + [duration]
+                                      )[-KEEP:]
+        try:
+            tmp_path = '%s.%d' % (self.summary_path, os.getpid())
+            with open(tmp_path, 'w') as summary_fd:
+                json.dump(summary, summary_fd)
+            os.rename(tmp_path, self.summary_path)
+        except (IOError, OSError):
+            pass
+        return summary
+
+    def durations(self, profile=None, os_id=None, host=None):
+        """
+        Latest build durations of the given host with the given profile, or
+        else of the given profile, or else of the given operating system
+
+        :returns: list of seconds, empty if there's no history
+        """
+        if self._summary is None:
+            self._summary = self._load()
+        durations = self._summary['durations']
+        for key in ('host:%s/%s' % (profile, host), 'profile:%s' % profile,
+                    'os:%s' % os_id):
+            if key in durations:
+                return durations[key]
+        return []
+
+    def expected(self, **kwargs):
+        """
+        Expected build duration in seconds (the median), None if unknown,
+        see :meth:`durations` for the parameters
+        """
+        return percentile(sorted(self.durations(**kwargs)), 50)
+
+    def timeout(self, **kwargs):
+        """
+        Reasonable build timeout in seconds (twice the 90th percentile),
+        None if unknown, see :meth:`durations` for the parameters
+        """
+        slow = percentile(sorted(self.durations(**kwargs)), 90)
+        return slow and slow * 2
+
+
+class DemandHistory(object):
+    """
+    Log of the provision requests, one tab separated line per request with
+    the timestamp, the profile and the amount of hosts requested
+
+    :param path: Path to the log file
+    """
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+    @classmethod
+    def from_env(cls, env):
+        """
+        Get the log at DEMAND_HISTORY from the fabricrc file, by default
+        ~/.fabric_ci/demand_history, set it to an empty value to disable it
+        """
+        path = env.get('DEMAND_HISTORY', '~/.fabric_ci/demand_history')
+        return path and cls(path) or None
+
+    def record(self, profile, amount, when=None):
+        """
+        Log a provision request
+
+        :param profile: Profile requested
+        :param amount: Number of hosts requested
+        :param when: Timestamp of the request, now by default
+        """
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            with open(self.path, 'a') as log_fd:
+                log_fd.write('%d\t%s\t%d\n' % (when or time.time(), profile,
+                                                int(amount)))
+        except (IOError, OSError) as exc:
+            warn("Unable to store the provision request: %s" % exc)
+
+    def requests(self, since):
+        """
+        Amounts requested per profile since the given timestamp
+
+        :returns: dictionary with profile -> list of amounts
+        """
+        requests = {}
+        try:
+            log_fd = open(self.path)
+        except IOError:
+            return requests
+        with log_fd:
+            for line in log_fd:
+                try:
+                    when, profile, amount = line.rstrip('\n').split('\t')
+                    if int(when) < since:
+                        continue
+                    requests.setdefault(profile, []).append(int(amount))
+                except ValueError:
+                    continue
+        return requests
+
+    def hot_profiles(self, since, max_profiles, max_size):
+        """
+        Profiles with the most hosts requested since the given timestamp,
+        with the number of hosts to keep ready for each, that is the amount
+        of 90% of the requests, up to max_size
+
+        :returns: list of (profile, num_hosts) tuples, hottest first
+        """
+        requests = self.requests(since)
+        ranked = sorted(requests.iteritems(),
+                        key=lambda item: sum(item[1]), reverse=True)
+        return [(profile, min(max_size, percentile(sorted(amounts), 90)))
+                for profile, amounts in ranked[:max_profiles]]
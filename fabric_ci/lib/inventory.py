@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+#encoding: utf-8
+"""
+Counts of the hosts per hostgroup and state (available, reserved, stuck,
+unavailable...), computed in a single pass over the host listings, so the
+summary tasks and the nagios checks share the same numbers.
+"""
+import time
+import calendar
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+## Hosts reserved for longer than this (in seconds) are considered stuck
+STUCK_TIMEOUT = 60 * 60 * 23
+MAX_WAIT = 60 * 60
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+## Reservation tags, as bit flags
+USER_RESERVED = 1
+UNAVAILABLE = 2
+## Timestamp of the start of each (year, month), see parse_date
+_MONTH_STARTS = {}
+
+
+def parse_date(date):
+    """
+    Parse a foreman UTC date, like 2014-01-31T23:59:59Z, into a timestamp.
+
+    The dates in the expected format are sliced by position instead of going
+    through strptime, and only the start of each month is computed with the
+    calendar, so it's cheap enough to parse the dates of thousands of hosts.
+
+    :returns: Seconds since the epoch, as an int
+    """
+    if len(date) == 20 and date[10] == 'T' and date[19] == 'Z':
+        try:
+            month = (int(date[0:4]), int(date[5:7]))
+            day, hour = int(date[8:10]), int(date[11:13])
+            minute, second = int(date[14:16]), int(date[17:19])
+        except ValueError:
+            pass
+        else:
+            if month not in _MONTH_STARTS:
+                _MONTH_STARTS[month] = calendar.timegm(
+                    month + (1, 0, 0, 0, 0, 0, 0))
+            return (_MONTH_STARTS[month] + (day - 1) * 86400 + hour * 3600
+                    + minute * 60 + second)
+    return calendar.timegm(time.strptime(date, DATE_FORMAT))
+
+
+class HostRecord(object):
+    """
+    Compact form of a foreman host record, with only the fields used here
+    and the parameters indexed by name, see :func:`host_record`
+
+    :param host_id: Id of the host
+    :param name: Name of the host
+    :param hostgroup_id: Id of the hostgroup of the host, if any
+    :param updated_at: Date of the last change of the host
+    :param params: dict with the parameter name -> value
+    :param reserved: Tuple with the value and the update date of the
+        RESERVED parameter, None if the host does not have it
+    """
+    __slots__ = ('id', 'name', 'hostgroup_id', 'updated_at', 'params',
+                 'reserved')
+
+    def __init__(self, host_id, name, hostgroup_id=None, updated_at=None,
+                 params=None, reserved=None):
+        self.id = host_id
+        self.name = name
+        self.hostgroup_id = hostgroup_id
+        self.updated_at = updated_at
+        self.params = params or {}
+        self.reserved = reserved
+
+    def __repr__(self):
+        return 'HostRecord(%r, %r)' % (self.id, self.name)
+
+
+def host_record(host):
+    """
+    Build the :class:`HostRecord` of a host as returned by foreman, with or
+    without the parameters, parsing them only once
+
+    :param host: Host as returned by foreman, or a HostRecord that is
+        returned as is
+    """
+    if isinstance(host, HostRecord):
+        return host
+    host = host['host']
+    if 'host_parameters' in host:
+        params, par_key = host['host_parameters'], 'host_parameter'
+    else:
+        params, par_key = host.get('parameters', ()), 'parameter'
+    params_dict, reserved = {}, None
+    for param in params:
+        param = param[par_key]
+        params_dict[param['name']] = param['value']
+        if param['name'].upper() == 'RESERVED':
+            reserved = (param['value'], param.get('updated_at'))
+    ## the listings with only some fields might not have even the name
+    return HostRecord(host.get('id'), host.get('name'),
+                      host.get('hostgroup_id'), host.get('updated_at'),
+                      params_dict, reserved)
+
+
+def reserved_param(host):
+    """
+    Get the RESERVED parameter of the given host
+
+    :param host: Host as returned by foreman or :class:`HostRecord`
+    :returns: tuple with the value and the update date of the parameter, or
+        (None, None) if the host has no such parameter
+    """
+    return host_record(host).reserved or (None, None)
+
+
+class Reservation(namedtuple('Reservation', 'tags reason updated_at')):
+    """
+    Parsed RESERVED parameter of a host
+
+    :param tags: USER_RESERVED and/or UNAVAILABLE flags
+    :param reason: Reason of the reservation
+    :param updated_at: Timestamp of the last change of the reservation, None
+        if unknown
+    """
+    __slots__ = ()
+
+    def is_stuck(self, now, timeout=STUCK_TIMEOUT):
+        return self.updated_at is not None and now - self.updated_at > timeout
+
+
+def reservation(host):
+    """
+    Classify the reservation of the given host, looking at its parameters
+    only once
+
+    :param host: Host with the parameters, as returned by foreman, or
+        :class:`HostRecord`
+    :returns: :class:`Reservation`, None if the host has no reason
+    """
+    reason, updated = reserved_param(host)
+    if not reason:
+        return None
+    tags = 0
+    if 'RESERVED' in reason:
+        tags |= USER_RESERVED
+    if 'UNAVAILABLE' in reason.upper():
+        tags |= UNAVAILABLE
+    if updated:
+        updated = parse_date(updated)
+    return Reservation(tags, reason, updated or None)
+
+
+def reservation_ages(hosts, now=None):
+    """
+    Seconds since the reservation of each of the given hosts was last
+    changed, all compared to the same moment
+
+    :param hosts: Host records with the parameters, as returned by foreman
+    :param now: Timestamp to compare to, now by default
+    :returns: list with the age of each host, in the same order, None for
+        the hosts without reason or date
+    """
+    now = now or time.time()
+    ages = []
+    for host in hosts:
+        reason, updated = reserved_param(host)
+        if reason and updated:
+            ages.append(now - parse_date(updated))
+        else:
+            ages.append(None)
+    return ages
+
+
+class Inventory(object):
+    """
+    Number of hosts per state and hostgroup id
+
+    :param stuck_timeout: Seconds after which a reserved host is stuck
+    :param now: Timestamp to compare the reservations to, now by default
+    """
+    def __init__(self, stuck_timeout=STUCK_TIMEOUT, now=None):
+        self.stuck_timeout = stuck_timeout
+        self.now = now or time.time()
+        self.counts = {}
+        self.totals = {}
+
+    def _count(self, state, gid):
+        groups = self.counts.setdefault(state, {})
+        groups[gid] = groups.get(gid, 0) + 1
+        self.totals[state] = self.totals.get(state, 0) + 1
+
+    def add(self, host, state):
+        """
+        Count a host, the reserved hosts are also counted as stuck and
+        unavailable if they are
+
+        :param host: Host as returned by foreman or :class:`HostRecord`
+        :param state: State the host is in, like available or reserved
+        """
+        host = host_record(host)
+        gid = host.hostgroup_id
+        self._count(state, gid)
+        if state != 'reserved':
+            return
+        record = reservation(host)
+        if record is None:
+            return
+        if record.tags & UNAVAILABLE:
+            self._count('unavailable', gid)
+        if record.is_stuck(self.now, self.stuck_timeout):
+            self._count('stuck', gid)
+
+    def feed(self, hosts, state):
+        """
+        Count all the given hosts as being in the given state, see
+        :meth:`add`
+        """
+        for host in hosts:
+            self.add(host, state)
+        return self
+
+    def total(self, state):
+        return self.totals.get(state, 0)
+
+    def by_group(self, state):
+        """
+        :returns: dict with hostgroup id -> number of hosts in that state
+        """
+        ## a copy, so the callers can change it
+        return dict(self.counts.get(state, {}))
+
+    def groups(self):
+        """
+        :returns: set with the ids of all the hostgroups that have hosts
+        """
+        gids = set()
+        for groups in self.counts.itervalues():
+            gids.update(groups)
+        return gids
+
+    def nagios_data(self, states, hgdict, gids=None):
+        """
+        Values to pass to :meth:`NagiosPlugin.add_data`, one entry for all
+        the hosts and one per hostgroup
+
+        :param states: States to report, in order
+        :param hgdict: dict with hostgroup id -> name
+        :param gids: Only add entries for the hostgroups with these ids, all
+            the ones with hosts by default
+        :returns: list of (tag, ((state, count), ...)) tuples
+        """
+        data = [('Global', tuple((state, self.total(state))
+                                 for state in states))]
+        groups = self.groups()
+        if gids is not None:
+            groups &= set(gids)
+        for gid in sorted(groups, key=lambda gid: hgdict.get(gid)):
+            data.append((hgdict.get(gid, 'No group'),
+                         tuple((state, self.by_group(state).get(gid, 0))
+                               for state in states)))
+        return data
+
+
+def provision_inventory(frm, prefix, **kwargs):
+    """
+    Get the available and the reserved hosts from the reserve plugin, both
+    listings at the same time, and count them
+
+    :param frm: Foreman client
+    :param prefix: Only get the available hosts in hostgroups that start
+        with this
+    :param kwargs: Any other parameters for :class:`Inventory`
+    """
+    listings = (
+        (frm.show_available, {'query': "hostgroup ~ %s%%" % prefix}),
+        (frm.show_reserved, {}),
+    )
+    pool = ThreadPool(len(listings))
+    try:
+        available, reserved = pool.map_async(
+            lambda listing: listing[0](**listing[1]),
+            listings).get(timeout=MAX_WAIT)
+    finally:
+        pool.close()
+    inventory = Inventory(**kwargs)
+    inventory.feed(available, 'available')
+    inventory.feed(reserved, 'reserved')
+    return inventory
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#encoding: utf-8
+"""
+Cheap checks to know if hosts are alive before opening a full ssh session to
+them. All the hosts are checked at the same time from a single thread, using
+non-blocking sockets.
+
+Only the hosts that fabric connects to directly can be checked this way, the
+ones behind a gateway or a ProxyCommand in the ssh config are left to the ssh
+session.
+"""
+import time
+import errno
+import socket
+import select
+from multiprocessing.pool import ThreadPool
+from fabric.api import env
+from fabric.network import normalize, ssh_config
+
+## Any ssh server must send this first (RFC 4253, section 4.2)
+BANNER_PREFIX = 'SSH-'
+BANNER_MAX_LEN = 255
+## Keep the number of sockets open at the same time under select's limit
+MAX_SOCKETS = 500
+## Max number of hosts to resolve at the same time
+RESOLVERS = 20
+MAX_WAIT = 60 * 60
+
+
+class _Check(object):
+    """
+    State of the check of a single host
+    """
+    def __init__(self, host_string):
+        self.host_string = host_string
+        self.sock = None
+        self.connected = False
+        self.banner = ''
+        self.alive = None
+
+    def start(self):
+        _, host, port = normalize(self.host_string)
+        try:
+            family, socktype, proto, _, addr = socket.getaddrinfo(
+                host, int(port), 0, socket.SOCK_STREAM)[0]
+            self.sock = socket.socket(family, socktype, proto)
+            self.sock.setblocking(0)
+            res = self.sock.connect_ex(addr)
+        except (socket.error, socket.gaierror):
+            return self.done(False)
+        if res not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.done(False)
+
+    def on_writable(self):
+        if self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+            return self.done(False)
+        self.connected = True
+
+    def on_readable(self):
+        try:
+            data = self.sock.recv(BANNER_MAX_LEN)
+        except socket.error:
+            return self.done(False)
+        if not data:
+            return self.done(False)
+        self.banner += data
+        if len(self.banner) >= len(BANNER_PREFIX) or '\n' in self.banner:
+            self.done(self.banner.startswith(BANNER_PREFIX))
+
+    def done(self, alive):
+        self.alive = alive
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+def is_direct(host_string):
+    """
+    Check if fabric connects straight to the host, not through env.gateway
+    nor a ProxyCommand from the ssh config, so it can be checked from here
+    """
+    if env.get('gateway'):
+        return False
+    return 'proxycommand' not in ssh_config(host_string)
+
+
+def check_hosts(hosts, timeout=None):
+    """
+    Check which hosts accept tcp connections to the ssh port and send an ssh
+    banner, all of them concurrently
+
+    The address and port are resolved like fabric does, with the HostName
+    and Port from the ssh config if env.use_ssh_config is set. The hosts
+    that are not reached directly (see :func:`is_direct`) are not checked.
+
+    :param hosts: list of fabric host strings
+    :param timeout: Max seconds to wait for all the hosts, env.timeout
+        (the fabric connection timeout) by default
+    :returns: dict with host string -> True if alive or not checked, False
+        otherwise
+    """
+    ## can't tell from here, let the ssh session decide
+    unchecked = dict((host, True) for host in hosts if not is_direct(host))
+    if unchecked:
+        unchecked.update(check_hosts(
+            [host for host in hosts if host not in unchecked],
+            timeout=timeout))
+        return unchecked
+    if len(hosts) > MAX_SOCKETS:
+        alive = {}
+        for start in range(0, len(hosts), MAX_SOCKETS):
+            alive.update(check_hosts(hosts[start:start + MAX_SOCKETS],
+                                     timeout=timeout))
+        return alive
+    deadline = time.time() + float(timeout or env.timeout)
+    checks = [_Check(host) for host in hosts]
+    ## name resolution blocks, so do it (and connect) from a few threads
+    pool = ThreadPool(min(RESOLVERS, len(checks) or 1))
+    try:
+        pool.map_async(_Check.start, checks).get(timeout=MAX_WAIT)
+    finally:
+        pool.close()
+    pending = [check for check in checks if check.alive is None]
+    while pending:
+        left = deadline - time.time()
+        if left <= 0:
+            break
+        readers = dict((check.sock.fileno(), check) for check in pending
+                       if check.connected)
+        writers = dict((check.sock.fileno(), check) for check in pending
+                       if not check.connected)
+        try:
+            readable, writable, _ = select.select(readers.keys(),
+                                                  writers.keys(), [], left)
+        except select.error as exc:
+            if exc.args[0] == errno.EINTR:
+                continue
+            raise
+        for fileno in writable:
+            writers[fileno].on_writable()
+        for fileno in readable:
+            readers[fileno].on_readable()
+        pending = [check for check in pending if check.alive is None]
+    for check in pending:
+        check.done(False)
+    return dict((check.host_string, check.alive) for check in checks)
+
+
+def is_alive(host, timeout=None):
+    """
+    Check if a single host accepts tcp connections to the ssh port and sends
+    the ssh banner, True if it can't be checked, see :func:`check_hosts`
+    """
+    return check_hosts([host], timeout=timeout)[host]
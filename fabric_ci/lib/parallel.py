@@ -5,18 +5,573 @@ codes to the responses
 """
 
 from __future__ import with_statement
+import os
+import csv
 import time
+import json
+import errno
+import cPickle
+import fcntl
+import select
+import signal
+import threading
+import traceback
 import Queue
 import sys
+import multiprocessing
+from collections import deque
+from fabric import state, tasks
 from fabric.network import ssh
 from fabric.context_managers import settings
-from utils import red, green, yellow, white
+from fabric.state import env
+from utils import red, green, yellow, white, cyan, TTY, percentile
 
 
 WHIPE = '\r' + ' '*80 + '\r'
+## Max seconds to block waiting for events, just a safety net in case some
+## wakeup gets lost, the loop is normally woken up by SIGCHLD or new results
+WAKEUP_TIMEOUT = 1
 
 
-def run(self):
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class ChildWatcher(object):
+    """
+    Self-pipe that gets written each time a child process exits (SIGCHLD), so
+    the job queue can sleep on select() until something actually happens
+    instead of polling all the running jobs every few milliseconds.
+
+    Use it as a context manager, it restores the previous signal handlers on
+    exit.
+    """
+    def __init__(self):
+        self._rfd, self._wfd = os.pipe()
+        _set_nonblocking(self._rfd)
+        _set_nonblocking(self._wfd)
+        self._old_handler = None
+        self._old_wakeup_fd = None
+        self.active = False
+
+    def __enter__(self):
+        try:
+            self._old_handler = signal.signal(signal.SIGCHLD,
+                                              lambda *args: None)
+        except ValueError:
+            ## not in the main thread, we can't get the signals, fallback to
+            ## the timeout
+            return self
+        ## avoid interrupting the other syscalls, select will still be
+        ## interrupted
+        signal.siginterrupt(signal.SIGCHLD, False)
+        self._old_wakeup_fd = signal.set_wakeup_fd(self._wfd)
+        self.active = True
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.active:
+            signal.set_wakeup_fd(self._old_wakeup_fd)
+            signal.signal(signal.SIGCHLD, self._old_handler)
+            self.active = False
+        os.close(self._rfd)
+        os.close(self._wfd)
+
+    def notify(self):
+        """
+        Wake up any pending wait, can be called from any thread
+        """
+        try:
+            os.write(self._wfd, '\0')
+        except OSError:
+            ## pipe full, there's already a wakeup pending
+            pass
+
+    def _drain(self):
+        try:
+            while os.read(self._rfd, 4096):
+                pass
+        except OSError as exc:
+            if exc.errno != errno.EAGAIN:
+                raise
+
+    def wait(self, fds=(), timeout=WAKEUP_TIMEOUT):
+        """
+        Block until a child exits, any of the given fds is readable or the
+        timeout expires.
+
+        :param fds: extra file descriptors to wait on
+        :param timeout: max seconds to wait
+        :rtype: list of the fds that are ready
+        """
+        if not self.active:
+            timeout = min(timeout, ssh.io_sleep)
+        try:
+            ready = select.select([self._rfd] + list(fds), [], [], timeout)[0]
+        except select.error as exc:
+            if exc.args[0] != errno.EINTR:
+                raise
+            ready = []
+        if self._rfd in ready:
+            self._drain()
+            ready.remove(self._rfd)
+        return ready
+
+
+class AIMDController(object):
+    """
+    Adaptive pool size, grows the number of concurrent jobs while they finish
+    fast and cleanly, and halves it when they start failing or getting slow
+    (additive increase / multiplicative decrease, like TCP congestion control)
+
+    The configured pool size (-z) is used as the ceiling. The latency and
+    failure rate are smoothed averages, so a single slow or broken host does
+    not make it back off.
+
+    Configured from the fabricrc file or with --set:
+        PARALLEL_ADAPTIVE = true
+        PARALLEL_ADAPTIVE_MIN = 1        (floor of concurrent jobs)
+        PARALLEL_ADAPTIVE_SLOW = 2       (back off when the recent job times
+                                          are this times the long term ones)
+        PARALLEL_ADAPTIVE_MAX_FAIL = 0.25 (back off when more than this ratio
+                                          of the jobs fail)
+    """
+    def __init__(self, ceiling, floor=1, slow_factor=2.0, max_fail=0.25,
+                 decrease=0.5, weight=0.2):
+        self.floor = max(1, int(floor))
+        self.ceiling = max(self.floor, int(ceiling))
+        self.slow_factor = float(slow_factor)
+        self.max_fail = float(max_fail)
+        self.decrease = float(decrease)
+        self.weight = float(weight)
+        ## Start small and add one slot per finished job (doubling each
+        ## round) until the first congestion signal, like tcp slow start
+        self.limit = float(self.floor)
+        self.threshold = float(self.ceiling)
+        ## recent and long term average of the job durations
+        self.latency = None
+        self.base_latency = None
+        self.fail_rate = 0.0
+        self._last_decrease = None
+
+    @classmethod
+    def from_env(cls, ceiling):
+        """
+        Get a controller configured from env, or None if not enabled
+        """
+        if str(env.get('PARALLEL_ADAPTIVE', 'false')).lower() != 'true':
+            return None
+        return cls(ceiling,
+                   floor=env.get('PARALLEL_ADAPTIVE_MIN', 1),
+                   slow_factor=env.get('PARALLEL_ADAPTIVE_SLOW', 2.0),
+                   max_fail=env.get('PARALLEL_ADAPTIVE_MAX_FAIL', 0.25))
+
+    @property
+    def concurrency(self):
+        return int(self.limit)
+
+    def congested(self):
+        if self.fail_rate > self.max_fail:
+            return True
+        return (self.latency is not None
+                and self.latency > self.base_latency * self.slow_factor)
+
+    def job_done(self, duration, failed, now=None):
+        """
+        Feed the result of a finished job to the controller
+
+        :param duration: seconds the job took
+        :param failed: if the job failed
+        :param now: current timestamp
+        :rtype: int, the new concurrency
+        """
+        now = now or time.time()
+        self.fail_rate += self.weight / 2 \
+            * (int(bool(failed)) - self.fail_rate)
+        if not failed:
+            if self.latency is None:
+                self.latency = self.base_latency = duration
+            else:
+                self.latency += self.weight * (duration - self.latency)
+                self.base_latency += self.weight / 10 \
+                    * (duration - self.base_latency)
+        if self.congested():
+            ## Only decrease once per 'round', the jobs that were already
+            ## running when we backed off will report the same congestion
+            if self._last_decrease is None \
+                    or now - self._last_decrease > (self.latency or 0):
+                self.threshold = max(self.floor, self.limit * self.decrease)
+                self.limit = self.threshold
+                self._last_decrease = now
+        elif self.limit < self.threshold:
+            self.limit = min(self.ceiling, self.limit + 1)
+        else:
+            self.limit = min(self.ceiling, self.limit + 1 / self.limit)
+        return self.concurrency
+
+
+class JobStats(object):
+    """
+    Per host timings of a parallel run, to find out which hosts are slowing
+    down the whole run.
+
+    If PARALLEL_REPORT is set in the env (fabricrc or --set), a json or csv
+    (depending on the extension) report will be written there at the end of
+    the run, and the latency percentiles and the slowest hosts (10 or
+    PARALLEL_REPORT_SLOWEST) will be shown with the final status.
+    """
+    FIELDS = ('host', 'exit_code', 'queue_wait', 'start', 'end', 'duration',
+              'result_size')
+
+    def __init__(self, time_start, report=None, slowest=10):
+        self.time_start = time_start
+        self.report = report
+        self.slowest = int(slowest)
+        self.jobs = {}
+
+    @classmethod
+    def from_env(cls, time_start):
+        return cls(time_start,
+                   report=env.get('PARALLEL_REPORT', None),
+                   slowest=env.get('PARALLEL_REPORT_SLOWEST', 10))
+
+    def _job(self, name):
+        if name not in self.jobs:
+            self.jobs[name] = dict.fromkeys(self.FIELDS)
+            self.jobs[name]['host'] = name
+        return self.jobs[name]
+
+    def started(self, name, when=None):
+        job = self._job(name)
+        job['start'] = when or time.time()
+        job['queue_wait'] = job['start'] - self.time_start
+
+    def finished(self, name, exit_code, when=None):
+        """
+        :rtype: float, seconds the job took
+        """
+        job = self._job(name)
+        job['end'] = when or time.time()
+        job['exit_code'] = exit_code
+        job['duration'] = job['end'] - job['start']
+        return job['duration']
+
+    def result(self, name, result):
+        """
+        Account the size of the result, only if a report was requested as it
+        has to serialize the result again
+        """
+        if not self.report:
+            return
+        try:
+            size = len(cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL))
+        except Exception:
+            size = None
+        self._job(name)['result_size'] = size
+
+    def durations(self):
+        return sorted(job['duration'] for job in self.jobs.itervalues()
+                      if job['duration'] is not None)
+
+    def percentiles(self):
+        durations = self.durations()
+        return dict(('p%d' % pct, percentile(durations, pct))
+                    for pct in (50, 95, 99))
+
+    def slowest_jobs(self):
+        return sorted((job for job in self.jobs.itervalues()
+                       if job['duration'] is not None),
+                      key=lambda job: job['duration'],
+                      reverse=True)[:self.slowest]
+
+    def write_report(self, path=None):
+        path = path or self.report
+        jobs = sorted(self.jobs.itervalues(), key=lambda job: job['start'])
+        with open(path, 'w') as report_fd:
+            if path.endswith('.csv'):
+                writer = csv.DictWriter(report_fd, self.FIELDS)
+                writer.writerow(dict(zip(self.FIELDS, self.FIELDS)))
+                writer.writerows(jobs)
+            else:
+                json.dump({
+                    'start': self.time_start,
+                    'wall_time': time.time() - self.time_start,
+                    'latency': self.percentiles(),
+                    'slowest': [job['host'] for job in self.slowest_jobs()],
+                    'jobs': jobs,
+                }, report_fd, indent=4)
+
+
+_THREAD_DATA = threading.local()
+
+
+class ThreadLocalDict(dict):
+    """
+    Mixin for fabric's env and output dicts, so each thread job can have its
+    own copy of them (as each process job has after the fork) while the main
+    thread keeps using the shared one.
+
+    Use :func:`make_thread_local` to apply it to an existing dict.
+    """
+    def _data(self):
+        return _THREAD_DATA.__dict__.get(id(self))
+
+    def bind_thread(self, data):
+        """
+        Use the given dict as storage for the current thread
+        """
+        _THREAD_DATA.__dict__[id(self)] = data
+
+    def __getitem__(self, key):
+        data = self._data()
+        if data is None:
+            return dict.__getitem__(self, key)
+        return data[key]
+
+    def __setitem__(self, key, value):
+        data = self._data()
+        if data is None:
+            return dict.__setitem__(self, key, value)
+        data[key] = value
+
+    def __delitem__(self, key):
+        data = self._data()
+        if data is None:
+            return dict.__delitem__(self, key)
+        del data[key]
+
+    def __contains__(self, key):
+        data = self._data()
+        if data is None:
+            return dict.__contains__(self, key)
+        return key in data
+
+    def __iter__(self):
+        data = self._data()
+        if data is None:
+            return dict.__iter__(self)
+        return iter(data)
+
+    def __len__(self):
+        data = self._data()
+        if data is None:
+            return dict.__len__(self)
+        return len(data)
+
+
+def _thread_local_method(name):
+    def method(self, *args, **kwargs):
+        data = self._data()
+        if data is None:
+            return getattr(dict, name)(self, *args, **kwargs)
+        return getattr(data, name)(*args, **kwargs)
+    method.__name__ = name
+    return method
+
+
+for _name in ('get', 'has_key', 'keys', 'values', 'items', 'iterkeys',
+              'itervalues', 'iteritems', 'update', 'pop', 'popitem',
+              'setdefault', 'copy', 'clear', '__repr__'):
+    setattr(ThreadLocalDict, _name, _thread_local_method(_name))
+
+
+def make_thread_local(obj):
+    """
+    Make the given dict subclass instance thread aware, see
+    :class:`ThreadLocalDict`
+    """
+    if not isinstance(obj, ThreadLocalDict):
+        ## _AttributeDict overrides __setattr__ to set keys
+        dict.__setattr__(obj, '__class__',
+                         type('ThreadLocal' + obj.__class__.__name__,
+                              (obj.__class__, ThreadLocalDict),
+                              {}))
+    return obj
+
+
+class ThreadJob(threading.Thread):
+    """
+    Drop-in replacement of the multiprocessing.Process jobs that fabric
+    creates, runs the same target in a thread with its own copy of env and
+    output, much cheaper than forking for lots of hosts and short tasks.
+
+    Enable it with PARALLEL_BACKEND = thread in the fabricrc file (or
+    with --set). Tasks that call disconnect_all (like provision.rebuild)
+    should keep using processes, as the connections cache is shared.
+    """
+    def __init__(self, process):
+        super(ThreadJob, self).__init__(target=process._target,
+                                        name=process.name,
+                                        args=process._args,
+                                        kwargs=process._kwargs)
+        self.daemon = True
+        self.exitcode = None
+        self.on_exit = None
+        self._env = None
+        self._output = None
+
+    def start(self):
+        ## take a snapshot of the current settings, like fork does
+        self._env = dict.copy(state.env)
+        self._output = dict.copy(state.output)
+        super(ThreadJob, self).start()
+
+    def run(self):
+        state.env.bind_thread(self._env)
+        state.output.bind_thread(self._output)
+        try:
+            super(ThreadJob, self).run()
+            self.exitcode = 0
+        except SystemExit as exc:
+            ## same exit codes a process would have
+            if not exc.args:
+                self.exitcode = 1
+            elif exc.args[0] is None:
+                self.exitcode = 0
+            elif isinstance(exc.args[0], int):
+                self.exitcode = exc.args[0]
+            else:
+                sys.stderr.write(str(exc.args[0]) + '\n')
+                self.exitcode = 1
+        except BaseException:
+            traceback.print_exc()
+            self.exitcode = 1
+        finally:
+            if self.on_exit:
+                self.on_exit()
+
+    def is_alive(self):
+        return self.exitcode is None and super(ThreadJob, self).is_alive()
+
+
+def _use_threads(self, watcher):
+    """
+    Replace the queued processes with thread jobs
+    """
+    make_thread_local(state.env)
+    make_thread_local(state.output)
+    ## multiprocessing queues send the data from a background thread, that
+    ## only waits for it to finish on process exit, a plain queue makes sure
+    ## the results are there when the thread job ends
+    self._comms_queue = Queue.Queue()
+    jobs = []
+    for process in self._queued:
+        if 'queue' in process._kwargs:
+            process._kwargs['queue'] = self._comms_queue
+        job = ThreadJob(process)
+        job.on_exit = watcher.notify
+        jobs.append(job)
+    self._queued = jobs
+
+
+class StatusLine(object):
+    """
+    Renders the job queue status line, at most `fps` times per second, and
+    only when the output is a terminal (or PARALLEL_STATUS = true is set), to
+    avoid flooding the CI logs. The colored templates are built only once.
+
+    It also shows the rate of finished hosts per second over the last
+    `window` seconds.
+    """
+    def __init__(self, fps=10, enabled=TTY, window=30):
+        self.enabled = enabled
+        self.min_interval = 1.0 / float(fps)
+        self.window = float(window)
+        self.template = "[%s/%s/%s] %s, %s, %s" % (
+            green('%d'), white('%d'), yellow('%d'),
+            green('finished'), white('running'), yellow('queued'))
+        self.rate_template = " %s" % cyan('%.1f hosts/s')
+        self.max_template = " (%s)" % cyan('%d max concurrent')
+        self._samples = deque()
+        self._last = None
+        self._last_draw = 0
+        self._pending = None
+
+    @classmethod
+    def from_env(cls):
+        enabled = env.get('PARALLEL_STATUS', None)
+        if enabled is None:
+            enabled = TTY
+        else:
+            enabled = str(enabled).lower() == 'true'
+        return cls(fps=env.get('PARALLEL_STATUS_FPS', 10), enabled=enabled)
+
+    def rate(self, now=None):
+        """
+        Finished hosts per second in the last window
+        """
+        now = now or time.time()
+        if len(self._samples) < 2:
+            return 0.0
+        first_time, first_done = self._samples[0]
+        last_time, last_done = self._samples[-1]
+        if now - first_time <= 0:
+            return 0.0
+        return (last_done - first_done) / (now - first_time)
+
+    def _sample(self, completed, now):
+        if not self._samples or self._samples[-1][1] != completed:
+            self._samples.append((now, completed))
+        while len(self._samples) > 2 \
+                and now - self._samples[1][0] > self.window:
+            self._samples.popleft()
+
+    def update(self, completed, running, queued, max_running=None):
+        """
+        Draw the status if it changed and it was not drawn too recently,
+        otherwise it's kept as pending until :meth:`flush`.
+        """
+        now = time.time()
+        self._sample(completed, now)
+        if not self.enabled:
+            return
+        state = (completed, running, queued, max_running)
+        if state == self._last:
+            self._pending = None
+            return
+        if now - self._last_draw < self.min_interval:
+            self._pending = state
+            return
+        self._draw(state, now)
+
+    def next_draw(self):
+        """
+        Seconds until the pending status can be drawn, None if nothing
+        pending
+        """
+        if self._pending is None:
+            return None
+        return max(0, self._last_draw + self.min_interval - time.time())
+
+    def flush(self):
+        if self._pending is not None:
+            self._draw(self._pending, time.time())
+
+    def _draw(self, state, now):
+        line = self.template % state[:3]
+        if state[3] is not None:
+            line += self.max_template % state[3]
+        line += self.rate_template % self.rate(now)
+        print WHIPE, line
+        sys.stdout.flush()
+        self._last = state
+        self._last_draw = now
+        self._pending = None
+
+
+def _comms_fds(comms_queue):
+    """
+    File descriptors that become readable when there are results in the
+    multiprocessing queue
+    """
+    reader = getattr(comms_queue, '_reader', None)
+    if reader is None:
+        return []
+    return [reader.fileno()]
+
+
+def iter_run(self):
     """
     This is the workhorse. It will take the intial jobs from the _queue,
     start them, add them to _running, and then go into the main running
@@ -24,12 +579,15 @@ def run(self):
 
     This loop will check for done procs, if found, move them out of
     _running into _completed. It also checks for a _running queue with open
-    spots, which it will then fill as discovered.
+    spots, which it will then fill as discovered. Between passes it sleeps
+    until a child exits or sends its results, instead of polling.
 
     To end the loop, there have to be no running procs, and no more procs
     to be run in the queue.
 
-    This function returns an iterable of all its children's exit codes.
+    This function is a generator that yields a (name, exit_code, result)
+    tuple for each job as soon as it finishes, the results are not kept so
+    the memory does not grow with the number of jobs.
     """
     def _advance_the_queue(self):
         """
@@ -47,14 +605,19 @@ def run(self):
             print("Popping '%s' off the queue and starting it" % job.name)
         with settings(clean_revert=True, host_string=job.name, host=job.name):
             job.start()
+        self._stats.started(job.name)
         self._running.append(job)
         self._status()
 
     self._time_start = time.time()
-    # Prep return value so we can start filling it during main loop
+    self._stats = JobStats.from_env(self._time_start)
+    self._status_line = StatusLine.from_env()
+    self._controller = AIMDController.from_env(self._max)
+    if self._controller:
+        self._max = self._controller.concurrency
+    self._errors = 0
+    # Results received for the jobs that have not been yielded yet
     results = {}
-    for job in self._queued:
-        results[job.name] = dict.fromkeys(('exit_code', 'results'))
 
     if not self._closed:
         raise Exception("Need to close() before starting.")
@@ -62,80 +625,173 @@ def run(self):
     if self._debug:
         print("Job queue starting.")
 
-    while len(self._running) < self._max:
-        _advance_the_queue(self)
-    self._status()
-
-    # Main loop!
-    while not self._finished:
+    with ChildWatcher() as watcher:
+        if env.get('PARALLEL_BACKEND', 'process') == 'thread':
+            _use_threads(self, watcher)
         while len(self._running) < self._max and self._queued:
             _advance_the_queue(self)
+        self._status()
 
-        if not self._all_alive():
-            for id, job in enumerate(self._running):
-                if not job.is_alive():
-                    if self._debug:
-                        print("Job queue found finished proc: %s." %
-                                job.name)
-                    done = self._running.pop(id)
-                    self._completed.append(done)
-
-            if self._debug:
+        # Main loop!
+        while not self._finished:
+            done = [job for job in self._running if not job.is_alive()]
+            for job in done:
+                if self._debug:
+                    print("Job queue found finished proc: %s." % job.name)
+                self._running.remove(job)
+                self._completed.append(job)
+                if job.exitcode != 0:
+                    self._errors += 1
+                duration = self._stats.finished(job.name, job.exitcode)
+                if self._controller:
+                    self._max = self._controller.job_done(
+                        duration,
+                        job.exitcode != 0)
+            if done and self._debug:
                 print("Job queue has %d running." % len(self._running))
 
-        if not (self._queued or self._running):
-            if self._debug:
-                print("Job queue finished.")
+            # Refill the free slots right away
+            while len(self._running) < self._max and self._queued:
+                _advance_the_queue(self)
 
-            for job in self._completed:
-                job.join()
-
-            self._finished = True
+            if not (self._queued or self._running):
+                if self._debug:
+                    print("Job queue finished.")
 
-        # Each loop pass, try pulling results off the queue to keep its
-        # size down.
-        self._fill_results(results)
+                for job in self._completed:
+                    job.join()
 
-        self._status()
-        time.sleep(ssh.io_sleep)
+                self._finished = True
 
-    self._status()
-    # Consume anything left in the results queue
-    self._fill_results(results)
+            # Each loop pass, try pulling results off the queue to keep its
+            # size down. The finished jobs flushed their results before
+            # exiting, so they are all there already.
+            self._fill_results(results)
+            self._status()
+            for job in done:
+                result = results.pop(job.name, {}).get('results')
+                yield job.name, job.exitcode, result
 
-    self._errors = 0
-    # Attach exit codes now that we're all done & have joined all jobs
-    for job in self._completed:
-        results[job.name]['exit_code'] = job.exitcode
-        if job.exitcode != 0:
-            self._errors += 1
+            if not self._finished:
+                # Sleep until a child exits or sends its results, or it's
+                # time to show the pending status
+                timeout = self._status_line.next_draw()
+                if timeout is None:
+                    timeout = WAKEUP_TIMEOUT
+                watcher.wait(_comms_fds(self._comms_queue),
+                             min(timeout, WAKEUP_TIMEOUT))
+                ## woken up by a child, only draw if it's time to
+                if self._status_line.next_draw() == 0:
+                    self._status_line.flush()
 
+    self._status_line.flush()
+    if self._stats.report:
+        self._stats.write_report()
     self._status(final=True)
+
+
+def run(self):
+    """
+    Run all the jobs, see :func:`iter_run`.
+
+    This function returns a dict with the exit code and the results of each
+    job, by job name.
+    """
+    results = {}
+    for name, exit_code, result in self.iter_run():
+        results[name] = {'exit_code': exit_code, 'results': result}
     return results
 
 
+def iexecute(task, *args, **kwargs):
+    """
+    Same as fabric's execute, but instead of returning all the results when
+    all the hosts are done, it yields a (host, exit_code, result) tuple as
+    soon as each host finishes, so the caller can start doing something with
+    the hosts that finished early. Tasks that are not parallel yield each
+    host after running them serially, with exit code 0.
+
+    As with execute, if a host fails and warn_only is not set, it aborts.
+    """
+    my_env = {'clean_revert': True}
+    if not (callable(task) or tasks._is_task(task)):
+        my_env['command'] = task
+        task = tasks.crawl(task, state.commands)
+        if task is None:
+            tasks.abort("%r is not callable or a valid task name"
+                        % (my_env['command'],))
+    else:
+        my_env['command'] = getattr(task, 'name',
+                                    getattr(task, '__name__', None))
+    if not tasks._is_task(task):
+        task = tasks.WrappedCallableTask(task)
+    new_kwargs, hosts, roles, exclude_hosts = tasks.parse_kwargs(kwargs)
+    my_env['all_hosts'] = task.get_hosts(hosts, roles, exclude_hosts,
+                                         state.env)
+
+    if not tasks.requires_parallel(task):
+        for host in my_env['all_hosts']:
+            result = tasks.execute(task, hosts=[host], *args, **new_kwargs)
+            yield host, 0, result[host]
+        return
+
+    pool_size = task.get_pool_size(my_env['all_hosts'], state.env.pool_size)
+    queue = multiprocessing.Queue()
+    jobs = tasks.JobQueue(pool_size, queue)
+    if state.output.debug:
+        jobs._debug = True
+    for host in my_env['all_hosts']:
+        try:
+            tasks._execute(task, host, my_env, args, new_kwargs, jobs, queue,
+                           multiprocessing)
+        except tasks.NetworkError as exc:
+            if not state.env.use_exceptions_for['network']:
+                func = state.env.skip_bad_hosts and tasks.warn or tasks.abort
+                tasks.error(exc.message, func=func, exception=exc.wrapped)
+            else:
+                raise
+            yield host, None, exc
+    if not jobs:
+        return
+    jobs.close()
+    err = "One or more hosts failed while executing task '%s'" \
+        % my_env['command']
+    for host, exit_code, result in jobs.iter_run():
+        if exit_code != 0:
+            if isinstance(result, BaseException):
+                tasks.error(err, exception=result)
+            else:
+                tasks.error(err)
+        yield host, exit_code, result
+
+
 def _status(self, final=False):
+    controller = getattr(self, '_controller', None)
     if not final:
-        new = (green(len(self._completed)),
-           white(len(self._running)),
-           yellow(len(self._queued)),
-           green('finished'),
-           white('running'),
-           yellow('queued'))
-        if hasattr(self, 'last_status') and new == self.last_status:
-            return
-        self.last_status = (green(len(self._completed)),
-            white(len(self._running)),
-            yellow(len(self._queued)),
-            green('finished'),
-            white('running'),
-            yellow('queued'))
-        print WHIPE, "[%s/%s/%s] %s, %s, %s" % new
+        self._status_line.update(len(self._completed),
+                                 len(self._running),
+                                 len(self._queued),
+                                 controller and self._max or None)
     else:
-        print "\n[ %s OK / %s ERROR ] in %s seconds" % (
+        elapsed = time.time() - self._time_start
+        print "\n[ %s OK / %s ERROR ] in %s seconds (%s hosts/s)" % (
                 green(self._num_of_jobs - self._errors, True),
                 red(self._errors),
-                time.time() - self._time_start)
+                elapsed,
+                cyan('%.1f' % (self._num_of_jobs / (elapsed or 1))))
+        if controller:
+            print "Adaptive concurrency ended at %s (max %s)" % (
+                cyan(self._max), cyan(controller.ceiling))
+        if self._stats.report:
+            print "Job times: %s" % ', '.join(
+                '%s=%s' % (pct, white('%.2fs' % value))
+                for pct, value in sorted(self._stats.percentiles().items())
+                if value is not None)
+            print "Slowest hosts:"
+            for job in self._stats.slowest_jobs():
+                print "\t%s %s" % (yellow(job['host']),
+                                   white('%.2fs' % job['duration']))
+            print "Report written to %s" % self._stats.report
         if self._errors:
             print red("Failures:", True)
             for job in self._completed:
@@ -147,16 +803,24 @@ def _status(self, final=False):
 def _fill_results(self, results):
     """
     Attempt to pull data off self._comms_queue and add to 'results' dict.
+
+    It does not block, the children flush their results before exiting, so
+    once they are all joined everything is already in the queue.
     """
     while True:
         try:
-            datum = self._comms_queue.get(timeout=1)
-            results[datum['name']]['results'] = datum['result']
+            datum = self._comms_queue.get_nowait()
+            results.setdefault(
+                datum['name'],
+                dict.fromkeys(('exit_code', 'results')),
+            )['results'] = datum['result']
+            self._stats.result(datum['name'], datum['result'])
         except Queue.Empty:
             break
 
 
 def monkey_patch(mod):
     mod.job_queue.JobQueue.run = run
+    mod.job_queue.JobQueue.iter_run = iter_run
     mod.job_queue.JobQueue._status = _status
     mod.job_queue.JobQueue._fill_results = _fill_results
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+#encoding: utf-8
+"""
+Evaluation of the foreman search strings we use to select hosts, like
+`hostgroup ~ ci_% AND ( name=host1 OR name=host2 )`, without going to the
+server.
+
+Only the name and hostgroup fields are supported, with the =, !=, ~ and !~
+operators, joined with AND/OR (an implicit AND between conditions, like
+foreman does) and grouped with parentheses. Anything else raises
+UnsupportedSearch, so the caller can ask the server instead.
+"""
+import re
+from fabric_ci.lib.inventory import host_record
+
+TOKENS = re.compile(r'\s*(?:(\()|(\))|(!=|!~|=|~)|"([^"]*)"|([^\s()=~!"]+))')
+FIELDS = ('name', 'hostgroup')
+
+
+class UnsupportedSearch(Exception):
+    """
+    The search string uses something that can't be evaluated locally
+    """
+    pass
+
+
+def tokenize(search):
+    """
+    Split the search string into (kind, value) tuples, kind being one of
+    'open', 'close', 'op', 'word'
+    """
+    tokens = []
+    pos = 0
+    search = search.strip()
+    while pos < len(search):
+        match = TOKENS.match(search, pos)
+        if not match or match.end() == pos:
+            raise UnsupportedSearch('Unable to parse %r at %d'
+                                    % (search, pos))
+        pos = match.end()
+        opened, closed, oper, quoted, word = match.groups()
+        if opened:
+            tokens.append(('open', opened))
+        elif closed:
+            tokens.append(('close', closed))
+        elif oper:
+            tokens.append(('op', oper))
+        elif quoted is not None:
+            tokens.append(('word', quoted))
+        else:
+            tokens.append(('word', word))
+    return tokens
+
+
+def like_regex(value):
+    """
+    Regular expression matching the same as foreman's ~ operator, that is a
+    case insensitive sql LIKE, with * as another wildcard like %. As
+    scoped_search does, runs of wildcards are collapsed into one, and the
+    value is looked for anywhere only if it has no wildcards at all.
+    """
+    value = re.sub(r'[%*]+', '%', value)
+    if '%' not in value:
+        value = '%' + value + '%'
+    regex = ''.join(char == '%' and '.*' or char == '_' and '.'
+                    or re.escape(char) for char in value)
+    return re.compile('^%s$' % regex, re.I | re.S)
+
+
+def _condition(field, oper, value):
+    if field not in FIELDS:
+        raise UnsupportedSearch('Unable to search by %s locally' % field)
+    if oper in ('=', '!='):
+        test = lambda actual: actual == value
+    else:
+        test = like_regex(value).match
+    negate = oper.startswith('!')
+
+    def condition(host):
+        actual = host[field]
+        if actual is None:
+            return False
+        return bool(test(actual)) != negate
+    return condition
+
+
+class _Parser(object):
+    """
+    Recursive descent parser that builds the predicates:
+
+        search    := and_expr (OR and_expr)*
+        and_expr  := term ([AND] term)*
+        term      := '(' search ')' | field op value
+    """
+    def __init__(self, search):
+        self.search = search
+        self.tokens = tokenize(search)
+        self.pos = 0
+
+    def peek(self, offset=0):
+        if self.pos + offset < len(self.tokens):
+            return self.tokens[self.pos + offset]
+        return (None, None)
+
+    def next(self, kind=None):
+        token = self.peek()
+        if token[0] is None or (kind and token[0] != kind):
+            raise UnsupportedSearch('Unable to parse %r, unexpected %s'
+                                    % (self.search, token[1] or 'end'))
+        self.pos += 1
+        return token[1]
+
+    def is_keyword(self, keyword):
+        kind, value = self.peek()
+        return kind == 'word' and value.upper() == keyword \
+            and self.peek(1)[0] != 'op'
+
+    def parse(self):
+        if not self.tokens:
+            return lambda host: True
+        predicate = self.parse_or()
+        if self.pos != len(self.tokens):
+            raise UnsupportedSearch('Unable to parse %r, unexpected %s'
+                                    % (self.search, self.peek()[1]))
+        return predicate
+
+    def parse_or(self):
+        preds = [self.parse_and()]
+        while self.is_keyword('OR'):
+            self.next()
+            preds.append(self.parse_and())
+        if len(preds) == 1:
+            return preds[0]
+        return lambda host: any(pred(host) for pred in preds)
+
+    def parse_and(self):
+        preds = [self.parse_term()]
+        while self.peek()[0] is not None and self.peek()[0] != 'close' \
+                and not self.is_keyword('OR'):
+            if self.is_keyword('AND'):
+                self.next()
+            preds.append(self.parse_term())
+        if len(preds) == 1:
+            return preds[0]
+        return lambda host: all(pred(host) for pred in preds)
+
+    def parse_term(self):
+        if self.peek()[0] == 'open':
+            self.next()
+            pred = self.parse_or()
+            self.next('close')
+            return pred
+        field = self.next('word').lower()
+        oper = self.next('op')
+        return _condition(field, oper, self.next('word'))
+
+
+def compile_search(search, hgdict):
+    """
+    Compile a foreman search string into a function that checks if a host
+    matches it
+
+    :param search: Foreman search string
+    :param hgdict: dict with hostgroup id -> name, to match the hostgroups
+    :returns: function that gets a host (as returned by foreman or a
+        :class:`HostRecord`) and returns True if it matches
+    :raises UnsupportedSearch: if the search can't be evaluated locally
+    """
+    predicate = _Parser(search or '').parse()
+
+    def matches(host):
+        host = host_record(host)
+        return predicate({
+            'name': host.name,
+            'hostgroup': hgdict.get(host.hostgroup_id),
+        })
+    return matches
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+#encoding: utf-8
+"""
+Local snapshot of the foreman inventory (hosts, hostgroups, parameters and
+reservation state) in a sqlite database, so the read only views can answer
+without going to the server.
+
+The snapshot is refreshed incrementally: only the hosts updated since the
+last refresh are fetched again, along with the current reservations, and
+from time to time everything is fetched again to forget the removed hosts.
+
+Configured from the fabricrc file:
+    INVENTORY_SNAPSHOT = ~/.cache/fabric_ci/inventory.sqlite
+    INVENTORY_SNAPSHOT_MAX_AGE = 60   (seconds)
+"""
+import os
+import time
+import sqlite3
+import threading
+from fabric.api import env
+from fabric_ci.lib.utils import absolute_import, warn
+from fabric_ci.lib.foreman import (
+    get_hostgroups,
+    show_hosts_details,
+    iter_hosts,
+)
+from fabric_ci.lib.inventory import HostRecord, host_record, reservation
+from fabric_ci.lib.search import compile_search, UnsupportedSearch
+
+frm_cli = absolute_import('foreman.client', ['ForemanException'])
+
+## Seconds between full refreshes, to forget the hosts removed from foreman
+FULL_REFRESH = 60 * 60 * 24
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS hostgroups (
+    id INTEGER PRIMARY KEY,
+    name TEXT
+);
+CREATE TABLE IF NOT EXISTS hosts (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    hostgroup_id INTEGER,
+    updated_at TEXT,
+    reserved TEXT,
+    reserved_tags INTEGER,
+    reserved_at INTEGER
+);
+CREATE TABLE IF NOT EXISTS params (
+    host_id INTEGER,
+    name TEXT,
+    value TEXT,
+    updated_at TEXT,
+    PRIMARY KEY (host_id, name)
+);
+CREATE INDEX IF NOT EXISTS hosts_name ON hosts (name);
+CREATE INDEX IF NOT EXISTS hosts_hostgroup ON hosts (hostgroup_id);
+CREATE INDEX IF NOT EXISTS hosts_reserved ON hosts (reserved_tags);
+CREATE INDEX IF NOT EXISTS params_host ON params (host_id);
+"""
+
+
+def is_reserved(value):
+    """
+    Check if the given RESERVED parameter value is of a reserved host, the
+    same way the reserve plugin does
+    """
+    return bool(value) and value != 'false'
+
+
+class InventorySnapshot(object):
+    """
+    :param path: Path to the sqlite database, created if it does not exist
+    :param max_age: Max seconds since the last refresh to use the snapshot
+        without refreshing it first
+    """
+    def __init__(self, path, max_age=60):
+        self.path = os.path.expanduser(path)
+        self.max_age = float(max_age)
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+
+    @classmethod
+    def from_env(cls, env):
+        """
+        Get the snapshot at INVENTORY_SNAPSHOT from the fabricrc file, None
+        if it's not set
+        """
+        path = env.get('INVENTORY_SNAPSHOT', '')
+        return path and cls(path, env.get('INVENTORY_SNAPSHOT_MAX_AGE', 60))
+
+    def _meta(self, key, default=None):
+        row = self._db.execute('SELECT value FROM meta WHERE key = ?',
+                               (key, )).fetchone()
+        return row and row[0] or default
+
+    def _set_meta(self, **values):
+        self._db.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                             values.items())
+
+    def age(self):
+        """
+        Seconds since the last refresh, None if never refreshed
+        """
+        last = self._meta('refreshed')
+        return last and time.time() - float(last)
+
+    def _store(self, hosts):
+        for host in hosts:
+            record = host_record(host)
+            reason, reserved_at = record.reserved or (None, None)
+            res = reservation(record)
+            self._db.execute(
+                'INSERT OR REPLACE INTO hosts VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (record.id, record.name, record.hostgroup_id,
+                 record.updated_at, reason, res and res.tags,
+                 res and res.updated_at))
+            self._db.execute('DELETE FROM params WHERE host_id = ?',
+                             (record.id, ))
+            ## only the date of the reservation is kept
+            self._db.executemany(
+                'INSERT OR REPLACE INTO params VALUES (?, ?, ?, ?)',
+                [(record.id, name, value,
+                  name.upper() == 'RESERVED' and reserved_at or None)
+                 for name, value in record.params.iteritems()])
+
+    def _changed_hosts(self, frm, full):
+        """
+        Get the index records of the hosts changed since the last refresh,
+        removing from the snapshot the hosts that are no longer in foreman
+        if all of them are listed
+        """
+        last = self._meta('last_updated_at')
+        if last and not full:
+            try:
+                return list(iter_hosts(
+                    frm, search='updated_at >= "%s"' % last))
+            except frm_cli.ForemanException:
+                warn('Unable to search by updated_at, listing all the hosts')
+        known = dict(self._db.execute('SELECT id, updated_at FROM hosts'))
+        hosts = list(iter_hosts(frm))
+        gone = set(known) - set(host['host']['id'] for host in hosts)
+        self._db.executemany('DELETE FROM hosts WHERE id = ?',
+                             [(host_id, ) for host_id in gone])
+        self._db.executemany('DELETE FROM params WHERE host_id = ?',
+                             [(host_id, ) for host_id in gone])
+        self._set_meta(full_refresh=time.time())
+        return [host for host in hosts
+                if known.get(host['host']['id'], '') !=
+                host['host'].get('updated_at')]
+
+    def refresh(self, frm, full=False):
+        """
+        Get from foreman the hostgroups, the hosts changed since the last
+        refresh and the current reservations
+
+        :param frm: Foreman client
+        :param full: If True, get all the hosts again
+        """
+        with self._lock:
+            if self._meta('url') != frm.url:
+                self._db.execute('DELETE FROM hosts')
+                self._db.execute('DELETE FROM params')
+                self._db.execute('DELETE FROM meta')
+            last_full = float(self._meta('full_refresh', 0))
+            full = full or time.time() - last_full > FULL_REFRESH
+            started = time.time()
+            self._db.execute('DELETE FROM hostgroups')
+            self._db.executemany(
+                'INSERT INTO hostgroups VALUES (?, ?)',
+                [(hg['hostgroup']['id'], hg['hostgroup']['name'])
+                 for hg in get_hostgroups(frm)])
+            changed = self._changed_hosts(frm, full)
+            self._store(show_hosts_details(frm, changed))
+            ## changing a parameter does not update the host, so get the
+            ## reservations from the reserve plugin too
+            if hasattr(frm, 'show_reserved'):
+                reserved = frm.show_reserved()
+                self._store(reserved)
+                ids = set(host_record(host).id for host in reserved)
+                released = [{'host': {'id': host_id, 'name': name}}
+                            for host_id, name, value in self._db.execute(
+                                'SELECT id, name, reserved FROM hosts')
+                            if host_id not in ids and is_reserved(value)]
+                self._store(show_hosts_details(frm, released))
+            last = max([host['host'].get('updated_at') or ''
+                        for host in changed]
+                       + [self._meta('last_updated_at', '')])
+            self._set_meta(url=frm.url, refreshed=started,
+                           last_updated_at=last)
+            self._db.commit()
+
+    def ensure_fresh(self, frm):
+        """
+        Refresh the snapshot if it's older than max_age
+        """
+        age = self.age()
+        if age is None or age > self.max_age:
+            self.refresh(frm)
+        return self
+
+    def hosts(self, where='', args=()):
+        """
+        Get the hosts from the snapshot
+
+        :param where: sql condition on the hosts table
+        :param args: Values for the placeholders in the condition
+        :returns: list of :class:`HostRecord`
+        """
+        where = where and ' WHERE ' + where
+        with self._lock:
+            hosts = [HostRecord(*row) for row in self._db.execute(
+                'SELECT id, name, hostgroup_id, updated_at FROM '
+                'hosts%s ORDER BY name' % where, args)]
+            by_id = dict((host.id, host) for host in hosts)
+            params = self._db.execute(
+                'SELECT host_id, name, value, updated_at FROM params '
+                'WHERE host_id IN (SELECT id FROM hosts%s)' % where, args)
+            for host_id, name, value, updated in params:
+                host = by_id[host_id]
+                host.params[name] = value
+                if name.upper() == 'RESERVED':
+                    host.reserved = (value, updated)
+        return hosts
+
+    def reserved_hosts(self):
+        """
+        Get the reserved hosts, like the reserve plugin's show_reserved, see
+        :meth:`hosts`
+        """
+        return self.hosts("reserved IS NOT NULL AND reserved != 'false'")
+
+    def hostgroup_names(self):
+        """
+        Dictionary with the hostgroup id -> name mapping
+        """
+        with self._lock:
+            return dict(self._db.execute('SELECT id, name FROM hostgroups'))
+
+    def search(self, query, reserved=False):
+        """
+        Get the hosts that match the given foreman search string, see
+        :func:`fabric_ci.lib.search.compile_search`
+
+        :param reserved: Only look among the reserved hosts
+        :raises UnsupportedSearch: if the search can't be evaluated locally
+        """
+        matches = compile_search(query, self.hostgroup_names())
+        hosts = reserved and self.reserved_hosts() or self.hosts()
+        return [host for host in hosts if matches(host)]
+
+
+_SNAPSHOTS = {}
+
+
+def get_snapshot(frm):
+    """
+    Get the snapshot configured in the fabricrc file, refreshed if it's
+    older than INVENTORY_SNAPSHOT_MAX_AGE
+
+    :param frm: Foreman client
+    :returns: :class:`InventorySnapshot` or None if not configured
+    """
+    path = env.get('INVENTORY_SNAPSHOT', '')
+    if not path:
+        return None
+    if path not in _SNAPSHOTS:
+        _SNAPSHOTS[path] = InventorySnapshot.from_env(env)
+    return _SNAPSHOTS[path].ensure_fresh(frm)
+
+
+def search_snapshot(frm, query, reserved=False):
+    """
+    Get the hosts that match the given foreman search string from the
+    snapshot, see :meth:`InventorySnapshot.search`
+
+    :returns: list of hosts, or None if there's no snapshot configured or
+        the search can't be evaluated locally, the server has to be asked
+    """
+    snapshot = get_snapshot(frm)
+    if not snapshot:
+        return None
+    try:
+        return snapshot.search(query, reserved=reserved)
+    except UnsupportedSearch:
+        return None
@@ -2,7 +2,9 @@
 #encoding: utf-8
 
 import datetime
+import math
 import sys
+import random
 import re
 import socket
 import getpass
@@ -231,3 +233,45 @@ def check_param(env_name, param_name, params, input_func=raw_input):
                             'configuration file' % (param_name, env_name))
         else:
             env[env_name] = params[param_name]
+
+
+def percentile(values, pct):
+    """
+    Nearest rank percentile of an already sorted list of values
+
+    :param values: sorted list of numbers
+    :param pct: percentile to get, from 0 to 100
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+class Backoff(object):
+    """
+    Jittered exponential back-off, each delay doubles the previous one up to
+    cap, and a random amount of up to half of it is substracted so the
+    clients waiting for the same thing don't retry all at the same time.
+    """
+    def __init__(self, base, cap, factor=2):
+        self.base = float(base)
+        self.cap = float(cap)
+        self.factor = factor
+        self.attempt = 0
+
+    def next(self):
+        """
+        Get the next delay to wait, in seconds
+        """
+        delay = min(self.cap, self.base * self.factor ** self.attempt)
+        ## once at the cap, stop growing the exponent so it can't overflow
+        if delay < self.cap:
+            self.attempt += 1
+        return random.uniform(delay / 2, delay)
+
+    def reset(self):
+        """
+        Start again from the base delay, after making some progress
+        """
+        self.attempt = 0
@@ -7,17 +7,14 @@ string.
 
 
 from fabric.api import task, runs_once, serial, env, abort, prompt
-from fabric_ci.lib.foreman import foreman_defaults
+from fabric_ci.lib.foreman import foreman_defaults, get_client, iter_hosts
+from fabric_ci.lib.snapshot import search_snapshot
+from fabric_ci.lib.inventory import host_record
 from fabric_ci.lib.utils import (
     yellow,
-    absolute_import,
 )
 
 
-## To avoid collisions with local module
-frm_cli = absolute_import('foreman.client', ['Foreman'])
-
-
 @task(default=True)
 @runs_once
 @serial
@@ -48,13 +45,12 @@ def search(firstcond='', sure='no', foreman=None, user=None, passwd=None, *conds
         conds.append(firstcond)
     searchstr = ' or '.join(conds)
     searchstr += ' or '.join('%s=%s' % item for item in kwconds.iteritems())
-    if user:
-        auth = (user, passwd)
-    else:
-        auth = None
-    frm = frm_cli.Foreman(foreman, auth)
-    for host in frm.index_hosts(search=searchstr, per_page=999):
-        env.hosts.append(host['host']['name'])
+    frm = get_client(foreman, user, passwd)
+    hosts = search_snapshot(frm, searchstr)
+    if hosts is None:
+        hosts = iter_hosts(frm, search=searchstr, fields=('name',))
+    for host in hosts:
+        env.hosts.append(host_record(host).name)
     print(yellow("Query used: \n\t\"%s\"" % searchstr))
     print(yellow("Got %d hosts: \n\t" % len(env.hosts)
                  + '\n\t'.join(env.hosts)))